@@ -1 +1,6 @@
+from model.CWNet_cls import build_cwnet
 
+
+def CWNET_ScanObjectNN(name='cwnet', **kwargs):
+    # ScanObjectNN has 15 object classes, any preset of CWNET_PRESETS can be used
+    return build_cwnet(name, num_classes=15, **kwargs)
@@ -0,0 +1,119 @@
+from __future__ import print_function
+import time
+import argparse
+import torch
+import torch.nn as nn
+import numpy as np
+import sklearn.metrics as metrics
+from torch.utils.data import DataLoader
+from util.data_util import ModelNet40
+from model.CWNet_cls import CWNET, knn, knn_ivf
+
+
+def recall(idx, idx_exact):
+    # fraction of the exact neighbors found by the approximate search
+    hit = (idx.unsqueeze(-1) == idx_exact.unsqueeze(-2)).any(dim=-1)
+    return hit.float().mean().item()
+
+
+def timeit(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat, out
+
+
+def bench_synthetic(args, device):
+    print('==> feature knn, B=%d, C=%d, k=%d' % (args.batch_size, args.dims, args.k))
+    for num_points in args.num_points_list:
+        x = torch.randn(args.batch_size, args.dims, num_points, device=device)
+        t_exact, idx_exact = timeit(lambda: knn(x, k=args.k), args.repeat, device)
+        print('N=%6d  exact  %8.2f ms' % (num_points, t_exact * 1000))
+        for n_probe in args.probes:
+            t, idx = timeit(lambda: knn_ivf(x, k=args.k, n_probe=n_probe), args.repeat, device)
+            print('N=%6d  probe=%-3d %8.2f ms  speedup %.2fx  recall %.4f'
+                  % (num_points, n_probe, t * 1000, t_exact / t, recall(idx, idx_exact)))
+
+
+def bench_modelnet40(args, device):
+    test_loader = DataLoader(ModelNet40(partition='test', num_points=1024),
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    model = CWNET().to(device)
+    model = nn.DataParallel(model)
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    model = model.eval()
+
+    # inputs of the feature-space knn in stages 2-4
+    stage_features = []
+    hooks = [m.register_forward_hook(lambda m, i, o: stage_features.append(o.detach()))
+             for m in (model.module.pointrans1, model.module.dfa2, model.module.dfa3)]
+
+    print('==> ModelNet40 test set')
+    for n_probe in [None] + args.probes:
+        model.module.knn_probe = n_probe
+        test_true = []
+        test_pred = []
+        recalls = []
+        elapsed = 0.0
+        with torch.no_grad():
+            for data, label in test_loader:
+                data = data.to(device).permute(0, 2, 1)
+                del stage_features[:]
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+                logits = model(data)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                elapsed += time.time() - start
+                if n_probe is not None and len(recalls) < 3 * args.recall_batches:
+                    for feat in stage_features:
+                        recalls.append(recall(knn_ivf(feat, k=20, n_probe=n_probe), knn(feat, k=20)))
+                test_true.append(label.numpy().reshape(-1))
+                test_pred.append(logits.max(dim=1)[1].cpu().numpy())
+        test_true = np.concatenate(test_true)
+        test_pred = np.concatenate(test_pred)
+        print('probe=%-5s acc %.6f  avg acc %.6f  %.2f ms/batch  recall %s'
+              % (n_probe if n_probe is not None else 'exact',
+                 metrics.accuracy_score(test_true, test_pred),
+                 metrics.balanced_accuracy_score(test_true, test_pred),
+                 elapsed * 1000 / len(test_loader),
+                 '%.4f' % np.mean(recalls) if recalls else '1.0000'))
+    for h in hooks:
+        h.remove()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Approximate feature knn benchmark')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='batch size of the synthetic benchmark')
+    parser.add_argument('--dims', type=int, default=128,
+                        help='feature dims of the synthetic benchmark')
+    parser.add_argument('--k', type=int, default=20,
+                        help='num of nearest neighbors')
+    parser.add_argument('--num_points_list', type=int, nargs='+', default=[1024, 4096, 8192],
+                        help='num of points of the synthetic benchmark')
+    parser.add_argument('--probes', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='n_probe settings of knn_ivf')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='timed repetitions')
+    parser.add_argument('--test_batch_size', type=int, default=16,
+                        help='Size of batch)')
+    parser.add_argument('--recall_batches', type=int, default=10,
+                        help='test batches used to measure the recall of stages 2-4')
+    parser.add_argument('--model_path', type=str, default='', metavar='N',
+                        help='Pretrained model path, skip ModelNet40 if empty')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(1)
+    bench_synthetic(args, device)
+    if args.model_path:
+        bench_modelnet40(args, device)
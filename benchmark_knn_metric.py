@@ -0,0 +1,92 @@
+from __future__ import print_function
+import time
+import argparse
+import torch
+import torch.nn as nn
+from model.CWNet_cls import knn_metric, get_adptive_dilated_graph_feature
+
+
+def knn_metric_reference(x, d, conv_op1, conv_op2, conv_op11, k):
+    # the previous implementation, select_idx built on the host as before but
+    # copied to x.device instead of torch.cuda.LongTensor so it also runs on the CPU
+    batch_size = x.size(0)
+    num_points = x.size(2)
+    inner = -2 * torch.matmul(x.transpose(2, 1), x)
+    xx = torch.sum(x ** 2, dim=1, keepdim=True)
+    pairwise_distance = -xx - inner - xx.transpose(2, 1)
+
+    metric = (-pairwise_distance).topk(k=d * k, dim=-1, largest=False)[0]  # B,N,100
+    metric_idx = (-pairwise_distance).topk(k=d * k, dim=-1, largest=False)[1]  # B,N,100
+    metric_trans = metric.permute(0, 2, 1)  # B,100,N
+    metric = conv_op1(metric_trans)  # B,50,N
+    metric = torch.squeeze(conv_op11(metric).permute(0, 2, 1), -1)  # B,N
+    # normalize function
+    metric = torch.sigmoid(-metric)
+    # projection function
+    metric = 5 * metric + 0.5
+    # scaling function
+
+    value1 = torch.where((metric >= 0.5) & (metric < 1.5), torch.full_like(metric, 1), torch.full_like(metric, 0))
+    value2 = torch.where((metric >= 1.5) & (metric < 2.5), torch.full_like(metric, 2), torch.full_like(metric, 0))
+    value3 = torch.where((metric >= 2.5) & (metric < 3.5), torch.full_like(metric, 3), torch.full_like(metric, 0))
+    value4 = torch.where((metric >= 3.5) & (metric < 4.5), torch.full_like(metric, 4), torch.full_like(metric, 0))
+    value5 = torch.where((metric >= 4.5) & (metric <= 5.5), torch.full_like(metric, 5), torch.full_like(metric, 0))
+
+    value = value1 + value2 + value3 + value4 + value5 # B,N
+
+    select_idx = torch.LongTensor(list(range(k))).to(x.device)  # k
+    select_idx = torch.unsqueeze(select_idx, 0).repeat(num_points, 1)  # N,k
+    select_idx = torch.unsqueeze(select_idx, 0).repeat(batch_size, 1, 1)  # B,N,k
+    value = torch.unsqueeze(value, -1).repeat(1, 1, k)  # B,N,k
+    select_idx = select_idx * value
+    select_idx = select_idx.long()
+    idx = pairwise_distance.topk(k=k * d, dim=-1)[1]  # (batch_size, num_points, k*d)
+    # dilatedly selecting k from k*d idx
+    idx = torch.gather(idx, dim=-1, index=select_idx)  # B,N,k
+    return idx
+
+
+def timeit(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat, out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the adaptive dilated knn against the previous version')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--dims', type=int, default=64,
+                        help='feature channels')
+    parser.add_argument('--num_points_list', type=int, nargs='+', default=[512, 1024, 2048])
+    parser.add_argument('--d', type=int, default=5,
+                        help='largest dilation rate')
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--no_cuda', type=bool, default=False)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    dk = args.d * args.k
+    conv_op1 = nn.Conv1d(dk, dk // 2, kernel_size=1).to(device)
+    conv_op2 = None  # unused by both versions
+    conv_op11 = nn.Conv1d(dk // 2, 1, kernel_size=1).to(device)
+    print('==> knn_metric, B=%d, C=%d, d=%d, k=%d, %s' % (args.batch_size, args.dims, args.d, args.k, device))
+    with torch.no_grad():
+        for num_points in args.num_points_list:
+            x = torch.randn(args.batch_size, args.dims, num_points, device=device)
+            t_ref, idx_ref = timeit(lambda: knn_metric_reference(x, args.d, conv_op1, conv_op2, conv_op11, args.k),
+                                    args.repeat, device)
+            t_new, idx_new = timeit(lambda: knn_metric(x, args.d, conv_op1, conv_op2, conv_op11, args.k),
+                                    args.repeat, device)
+            t_feat, _ = timeit(lambda: get_adptive_dilated_graph_feature(x, conv_op1, conv_op2, conv_op11,
+                                                                         d=args.d, k=args.k), args.repeat, device)
+            print('N=%5d  previous %8.2f ms  single topk %8.2f ms  speedup %.2fx  identical %s  graph feature %8.2f ms'
+                  % (num_points, t_ref * 1000, t_new * 1000, t_ref / t_new, torch.equal(idx_ref, idx_new),
+                     t_feat * 1000))
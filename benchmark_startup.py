@@ -0,0 +1,51 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# runs in a fresh interpreter, so every import is cold
+STARTUP = '''
+import time, json, sys
+start = time.time()
+import torch
+t_torch = time.time()
+from model.CWNet_cls import build_cwnet
+t_import = time.time()
+model = build_cwnet(sys.argv[1]).eval()
+if sys.argv[2]:
+    state = torch.load(sys.argv[2], map_location='cpu')
+    model.load_state_dict({k[len('module.'):] if k.startswith('module.') else k: v for k, v in state.items()})
+t_load = time.time()
+with torch.no_grad():
+    model(torch.rand(1, 3, int(sys.argv[3])))
+t_pred = time.time()
+print(json.dumps(dict(torch=t_torch - start, model_import=t_import - t_torch,
+                      build_and_load=t_load - t_import, first_prediction=t_pred - t_load,
+                      total=t_pred - start)))
+'''
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time from interpreter start to the first prediction')
+    parser.add_argument('--model', type=str, default='cwnet',
+                        help='model variant')
+    parser.add_argument('--model_path', type=str, default='',
+                        help='checkpoint to load (default: random weights)')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='cold starts to measure')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(args.repeat):
+        out = subprocess.check_output([sys.executable, '-c', STARTUP, args.model, args.model_path,
+                                       str(args.num_points)], cwd=root)
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+    for key in ['torch', 'model_import', 'build_and_load', 'first_prediction', 'total']:
+        print('%-17s median %8.1f ms  min %8.1f ms' % (key, np.median([r[key] for r in runs]) * 1000,
+                                                     min(r[key] for r in runs) * 1000))
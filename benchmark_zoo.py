@@ -0,0 +1,102 @@
+from __future__ import print_function
+import time
+import argparse
+import torch
+import torch.nn as nn
+import numpy as np
+import sklearn.metrics as metrics
+from torch.utils.data import DataLoader
+from util.data_util import ModelNet40
+from model.CWNet_cls import build_cwnet, CWNET_PRESETS
+
+
+def latency(model, batch_size, num_points, repeat, device):
+    data = torch.rand(batch_size, 3, num_points, device=device)
+    with torch.no_grad():
+        for _ in range(3):
+            model(data)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            model(data)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) * 1000 / repeat
+
+
+def accuracy(model, model_path, test_loader, device):
+    model = nn.DataParallel(model)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model = model.eval()
+    test_true = []
+    test_pred = []
+    with torch.no_grad():
+        for data, label in test_loader:
+            logits = model(data.to(device).permute(0, 2, 1))
+            test_true.append(label.numpy().reshape(-1))
+            test_pred.append(logits.max(dim=1)[1].cpu().numpy())
+    return metrics.accuracy_score(np.concatenate(test_true), np.concatenate(test_pred))
+
+
+def pareto_front(rows):
+    # rows with accuracy, sorted by latency, keep the ones more accurate than every faster row
+    front = []
+    for row in sorted([r for r in rows if r['acc'] is not None], key=lambda r: r['latency']):
+        if not front or row['acc'] > front[-1]['acc']:
+            front.append(row)
+    return front
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CWNET model zoo benchmark')
+    parser.add_argument('--presets', type=str, nargs='+', default=sorted(CWNET_PRESETS),
+                        help='presets to benchmark')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='batch size of the latency measurement')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='timed repetitions')
+    parser.add_argument('--ckpt', type=str, nargs='*', default=[],
+                        help='preset=model_path pairs to evaluate on ModelNet40')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='latency budget in ms, report the most accurate preset that fits')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    ckpts = dict(c.split('=', 1) for c in args.ckpt)
+    test_loader = None
+    if ckpts:
+        test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points),
+                                 batch_size=16, shuffle=False, drop_last=False)
+
+    rows = []
+    for name in args.presets:
+        model = build_cwnet(name).to(device).eval()
+        row = dict(name=name,
+                   params=sum(p.numel() for p in model.parameters()) / 1e6,
+                   latency=latency(model, args.batch_size, args.num_points, args.repeat, device),
+                   acc=accuracy(model, ckpts[name], test_loader, device) if name in ckpts else None)
+        rows.append(row)
+        print('%-10s params %6.2fM  %8.2f ms/batch  acc %s'
+              % (name, row['params'], row['latency'], '%.4f' % row['acc'] if row['acc'] is not None else '-'))
+
+    front = pareto_front(rows)
+    if front:
+        print('==> accuracy/latency Pareto front')
+        for row in front:
+            print('%-10s %8.2f ms  acc %.4f' % (row['name'], row['latency'], row['acc']))
+    if args.budget is not None:
+        if front:
+            # the front is sorted by latency, its last row in budget is the most accurate
+            fits = [r for r in front if r['latency'] <= args.budget]
+        else:
+            # no accuracies, fall back to the largest preset in budget
+            fits = sorted([r for r in rows if r['latency'] <= args.budget], key=lambda r: r['params'])
+        if fits:
+            print('==> within %.2f ms: %s' % (args.budget, fits[-1]['name']))
+        else:
+            print('==> no preset within %.2f ms' % args.budget)
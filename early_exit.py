@@ -0,0 +1,106 @@
+from __future__ import print_function
+import time
+import argparse
+import torch
+import torch.nn as nn
+import numpy as np
+from torch.utils.data import DataLoader, Subset
+from util.data_util import ModelNet40, train_val_split
+from model.CWNet_cls import build_cwnet, CWNET_PRESETS
+
+
+def collect(net, loader, device):
+    # confidence of every exit and correctness of every exit plus the full network
+    conf = []
+    correct = []
+    with torch.no_grad():
+        for data, label in loader:
+            data, label = data.to(device).permute(0, 2, 1), label.to(device).view(-1)
+            logits, exit_logits = net(data, return_exits=True)
+            probs = [torch.softmax(l, dim=-1) for l in exit_logits]
+            conf.append(torch.stack([p.max(dim=-1)[0] for p in probs]).cpu().numpy())
+            correct.append(torch.stack([l.max(dim=-1)[1] == label for l in exit_logits + [logits]]).cpu().numpy())
+    return np.concatenate(conf, axis=1), np.concatenate(correct, axis=1)
+
+
+def calibrate(conf, correct, target):
+    '''
+        per exit, the lowest threshold at which the clouds still reaching that exit
+        and leaving there are classified with at least the target accuracy.
+    '''
+    remaining = np.ones(conf.shape[1], dtype=bool)
+    thresholds = []
+    for i in range(conf.shape[0]):
+        c = conf[i][remaining]
+        order = np.argsort(-c)
+        acc = np.cumsum(correct[i][remaining][order]) / np.arange(1, len(order) + 1)
+        ok = np.nonzero(acc >= target)[0]
+        t = c[order][ok[-1]] if len(ok) else 1.01  # 1.01: never exit
+        thresholds.append(float(t))
+        remaining &= conf[i] < t
+    return thresholds
+
+
+def evaluate(net, loader, thresholds, device):
+    preds = []
+    labels = []
+    stages = []
+    elapsed = 0.0
+    with torch.no_grad():
+        for data, label in loader:
+            data = data.to(device).permute(0, 2, 1)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            logits, exit_stage = net.forward_early_exit(data, thresholds)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += time.time() - start
+            preds.append(logits.max(dim=-1)[1].cpu().numpy())
+            labels.append(label.numpy().reshape(-1))
+            stages.append(exit_stage.cpu().numpy())
+    preds, labels, stages = np.concatenate(preds), np.concatenate(labels), np.concatenate(stages)
+    return np.mean(preds == labels), elapsed * 1000 / len(labels), stages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Calibrate and evaluate the early exits of CWNET')
+    parser.add_argument('--model', type=str, default='cwnet', choices=sorted(CWNET_PRESETS),
+                        help='model variant')
+    parser.add_argument('--exits', type=int, nargs='+', default=[2, 3],
+                        help='stages with an early exit classifier, as in training')
+    parser.add_argument('--model_path', type=str, default='checkpoints/cls/best_model.t7', metavar='N',
+                        help='Pretrained model path')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--val_split', type=float, default=0.1,
+                        help='held-out fraction of the train partition, as in training')
+    parser.add_argument('--test_batch_size', type=int, default=16,
+                        help='Size of batch)')
+    parser.add_argument('--targets', type=float, nargs='+', default=[0.9, 0.95, 0.98, 0.99],
+                        help='accuracy required from the clouds leaving at an exit')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    model = nn.DataParallel(build_cwnet(args.model, exits=args.exits).to(device))
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    net = model.module.eval()
+
+    train_set = ModelNet40(partition='train', num_points=args.num_points, augment=False)
+    val_set = Subset(train_set, train_val_split(len(train_set), args.val_split)[1])
+    val_loader = DataLoader(val_set, batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points),
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+
+    conf, correct = collect(net, val_loader, device)
+    settings = [('full', [1.01] * len(args.exits))]
+    settings += [('target %.2f' % t, calibrate(conf, correct, t)) for t in args.targets]
+
+    print('==> ModelNet40 test set, exits after stages %s' % args.exits)
+    for name, thresholds in settings:
+        acc, latency, stages = evaluate(net, test_loader, thresholds, device)
+        share = ' '.join('stage%d %.2f' % (s, np.mean(stages == s)) for s in args.exits + [net.num_stages])
+        print('%-12s thresholds %s  acc %.6f  %.3f ms/cloud  exits: %s'
+              % (name, ' '.join('%.3f' % t for t in thresholds), acc, latency, share))
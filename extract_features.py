@@ -0,0 +1,65 @@
+from __future__ import print_function
+import time
+import argparse
+import torch
+import torch.nn as nn
+import numpy as np
+from util.data_util import ModelNet40, build_loader
+from model.CWNet_cls import build_cwnet, CWNET_PRESETS
+
+
+def extract(model, loader, out, num_clouds, emb_dims, dtype='float32'):
+    '''
+        writes the pooled global features of every cloud to <out>.npy and the
+        labels to <out>_label.npy, both memory-mapped so the matrix never has to
+        fit in RAM.
+    '''
+    features = np.lib.format.open_memmap(out + '.npy', mode='w+', dtype=dtype, shape=(num_clouds, emb_dims))
+    labels = np.lib.format.open_memmap(out + '_label.npy', mode='w+', dtype='int64', shape=(num_clouds,))
+    row = 0
+    with torch.no_grad():
+        for data, label in loader:
+            feat = model(data.permute(0, 2, 1), return_embedding=True)
+            features[row:row + feat.size(0)] = feat.cpu().numpy().astype(dtype)
+            labels[row:row + feat.size(0)] = label.cpu().numpy().reshape(-1)
+            row += feat.size(0)
+    features.flush()
+    labels.flush()
+    return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract CWNET global shape features')
+    parser.add_argument('--model', type=str, default='cwnet', choices=sorted(CWNET_PRESETS),
+                        help='model variant')
+    parser.add_argument('--model_path', type=str, default='checkpoints/cls/best_model.t7', metavar='N',
+                        help='Pretrained model path')
+    parser.add_argument('--partition', type=str, default='test',
+                        help='ModelNet40 partition to extract')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='Size of batch)')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='data loading workers (default: -1, one per free core)')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='storage type of the features')
+    parser.add_argument('--out', type=str, required=True,
+                        help='output prefix, writes <out>.npy and <out>_label.npy')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    model = nn.DataParallel(build_cwnet(args.model).to(device))
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    model = model.eval()
+
+    dataset = ModelNet40(partition=args.partition, num_points=args.num_points, augment=False)
+    loader = build_loader(dataset, batch_size=args.batch_size, shuffle=False, drop_last=False,
+                          num_workers=args.num_workers, device=device)
+    emb_dims = 2 * model.module.out[0].out_channels
+    start = time.time()
+    count = extract(model, loader, args.out, len(dataset), emb_dims, args.dtype)
+    print('%d x %d features -> %s.npy (%.1f clouds/s)' % (count, emb_dims, args.out,
+                                                          count / (time.time() - start)))
@@ -0,0 +1,94 @@
+from __future__ import print_function
+import os
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from util.data_util import build_loader
+from util.scene_util import tile_scene, SceneWindows
+from model.CWNet_cls import build_cwnet, CWNET_PRESETS, knn_point
+
+
+def classify_tile(model, item, batch_size, device):
+    '''
+        runs the windows of one tile through the model and merges their class
+        probabilities onto the core points: the mean over the windows holding a
+        point, the window of the nearest seed for the points in no window.
+        output: probs, [num_core,num_classes]
+    '''
+    windows, neighbors, points, rows, seeds, num_core = item
+    with torch.no_grad():
+        window_probs = torch.cat([torch.softmax(model(windows[i:i + batch_size].to(device).permute(0, 2, 1)), dim=-1)
+                                  for i in range(0, len(windows), batch_size)], dim=0).cpu()  # S,num_classes
+    probs = torch.zeros(len(points), window_probs.size(1))
+    hits = torch.zeros(len(points))
+    probs.index_add_(0, neighbors.reshape(-1), window_probs.repeat_interleave(neighbors.size(1), dim=0))
+    hits.index_add_(0, neighbors.reshape(-1), torch.ones(neighbors.numel()))
+    probs = probs[:num_core] / hits[:num_core].clamp(min=1).view(-1, 1)
+    missed = (hits[:num_core] == 0).nonzero().view(-1)
+    if len(missed):
+        nearest = knn_point(1, points[seeds][None], points[missed][None])[0, :, 0]
+        probs[missed] = window_probs[nearest]
+    return probs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tiled CWNET inference on large scenes')
+    parser.add_argument('--scene', type=str, required=True,
+                        help='[P,C] .npy scene, xyz first')
+    parser.add_argument('--out', type=str, required=True,
+                        help='output prefix, writes <out>_label.npy and <out>_conf.npy')
+    parser.add_argument('--tiles', type=str, default='',
+                        help='tile directory (default: <out>_tiles), reused if it has an index.json')
+    parser.add_argument('--tile_size', type=float, default=10.0,
+                        help='xy size of the tiles, in scene units')
+    parser.add_argument('--halo', type=float, default=1.0,
+                        help='border around every tile that its windows can also use')
+    parser.add_argument('--chunk', type=int, default=1 << 20,
+                        help='scene points read at a time while tiling')
+    parser.add_argument('--model', type=str, default='cwnet', choices=sorted(CWNET_PRESETS),
+                        help='model variant')
+    parser.add_argument('--model_path', type=str, default='checkpoints/cls/best_model.t7',
+                        help='Pretrained model path')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='points per window')
+    parser.add_argument('--coverage', type=float, default=2.0,
+                        help='windows per core point on average')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='windows per forward pass')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='tiles prepared in parallel (default: -1, one per free core)')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    model = nn.DataParallel(build_cwnet(args.model).to(device))
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    model = model.eval()
+
+    start = time.time()
+    tiles = args.tiles or args.out + '_tiles'
+    if not os.path.exists(os.path.join(tiles, 'index.json')):
+        tile_scene(args.scene, tiles, args.tile_size, args.halo, args.chunk)
+    dataset = SceneWindows(tiles, num_points=args.num_points, coverage=args.coverage)
+    print('%d points in %d tiles (%.1fs)' % (dataset.index['num_points'], len(dataset), time.time() - start))
+
+    # every core point belongs to one tile, the tiles write disjoint rows
+    num_points = dataset.index['num_points']
+    labels = np.lib.format.open_memmap(args.out + '_label.npy', mode='w+', dtype='int16', shape=(num_points,))
+    conf = np.lib.format.open_memmap(args.out + '_conf.npy', mode='w+', dtype='float16', shape=(num_points,))
+    loader = build_loader(dataset, batch_size=None, shuffle=False, drop_last=False, num_workers=args.num_workers)
+    start = time.time()
+    for item in loader:
+        probs = classify_tile(model, item, args.batch_size, device)
+        rows = item[3][:item[5]].numpy()
+        p, label = probs.max(dim=1)
+        labels[rows] = label.numpy()
+        conf[rows] = p.numpy()
+    labels.flush()
+    conf.flush()
+    elapsed = time.time() - start
+    print('%d points -> %s_label.npy (%.0f points/s, loader stall %.1fs)'
+          % (num_points, args.out, num_points / elapsed, loader.stall_time))
@@ -5,11 +5,13 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import CosineAnnealingLR
-from util.data_util import ModelNet40
-from model.CWNet_cls import CWNET
+from util.data_util import ModelNet40, build_loader, train_val_split, dequantize_collate
+from model.CWNet_cls import build_cwnet, CWNET_PRESETS
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.utils.data import Subset
 from util.util import cal_loss, IOStream
+from util.memory_util import tune_batch_size
+from util.shard_util import ShardedPointCloudDataset
 import sklearn.metrics as metrics
 
 
@@ -46,16 +48,61 @@ def _init_():
         os.system('cp util.data_util.py checkpoints' + '/' + args.exp_name + '/' + 'data_util.py.backup')
 
 
-def train(args, io):
-    train_loader = DataLoader(ModelNet40(partition='train', num_points=args.num_points), num_workers=8,
-                              batch_size=args.batch_size, shuffle=True, drop_last=True)
-    test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points), num_workers=8,
-                             batch_size=args.test_batch_size, shuffle=True, drop_last=False)
+def auto_batch_size(args, model, io):
+    # largest train/test batch that fits the memory budget on every device
+    if args.mem_budget > 0:
+        budget = args.mem_budget * 1024 ** 3
+    elif args.cuda:
+        budget = 0.9 * torch.cuda.mem_get_info()[0]
+    else:
+        io.cprint('--auto_batch on the CPU needs --mem_budget, keeping the batch sizes')
+        return
+    num_devices = torch.cuda.device_count() if args.cuda else 1
+    args.batch_size = tune_batch_size(model, args.num_points, budget, training=True) * num_devices
+    args.test_batch_size = tune_batch_size(model, args.num_points, budget, training=False) * num_devices
+    io.cprint('Auto batch size for %.2fGB per device: train %d, test %d' % (budget / 1024 ** 3,
+                                                                          args.batch_size, args.test_batch_size))
+
+
+def model_kwargs(args):
+    kwargs = dict(knn_probe=args.knn_probe, exits=args.exits)
+    if args.k is not None:
+        kwargs['k'] = args.k
+    return kwargs
+
 
+def train(args, io, train_set=None, test_set=None, report=None):
+    '''
+        train_set, test_set: ModelNet40 sets already in memory (sweep_cls.py shares one between trials)
+        report: called with (epoch, test_acc) after every epoch, training stops when it returns False
+        returns the best test accuracy
+    '''
     device = torch.device("cuda" if args.cuda else "cpu")
 
-    model = CWNET().to(device)
+    model = build_cwnet(args.model, **model_kwargs(args)).to(device)
     print(str(model))
+    if args.auto_batch:
+        auto_batch_size(args, model, io)
+
+    if train_set is None and args.train_shards:
+        train_set = ShardedPointCloudDataset(args.train_shards, num_points=args.num_points,
+                                             shuffle_buffer=args.shuffle_buffer, augment=True, seed=args.seed)
+    elif train_set is None:
+        train_set = ModelNet40(partition='train', num_points=args.num_points, quantize=args.quantize)
+    if args.val_split > 0 and not args.train_shards:
+        # hold out the validation split used to calibrate the early exits
+        train_set = Subset(train_set, train_val_split(len(train_set), args.val_split)[0])
+    collate_fn = dequantize_collate if args.quantize else None
+    train_loader = build_loader(train_set,
+                                batch_size=args.batch_size, shuffle=True, drop_last=True,
+                                num_workers=args.num_workers, prefetch=args.prefetch, device=device,
+                                collate_fn=None if args.train_shards else collate_fn)
+    if test_set is None:
+        test_set = ModelNet40(partition='test', num_points=args.num_points, quantize=args.quantize)
+    test_loader = build_loader(test_set,
+                               batch_size=args.test_batch_size, shuffle=True, drop_last=False,
+                               num_workers=args.num_workers, prefetch=args.prefetch, device=device,
+                               collate_fn=collate_fn)
 
     # .model.apply(weight_init)
     model = nn.DataParallel(model)
@@ -89,8 +136,14 @@ def train(args, io):
             data = data.permute(0, 2, 1)
             batch_size = data.size()[0]
             opt.zero_grad()
-            logits = model(data)
-            loss = criterion(logits, label)
+            if args.exits:
+                logits, exit_logits = model(data, return_exits=True)
+                loss = criterion(logits, label)
+                for exit_l in exit_logits:
+                    loss = loss + args.exit_weight * criterion(exit_l, label)
+            else:
+                logits = model(data)
+                loss = criterion(logits, label)
             loss.backward()
             opt.step()
             preds = logits.max(dim=1)[1]
@@ -136,19 +189,31 @@ def train(args, io):
                                                                               test_acc,
                                                                               avg_per_class_acc)
         io.cprint(outstr)
+        io.cprint('Loader stall %d, train: %.3fs, test: %.3fs' % (epoch, train_loader.stall_time,
+                                                                 test_loader.stall_time))
         if test_acc >= best_test_acc:
             best_test_acc = test_acc
             io.cprint('Max Acc:%.6f' % best_test_acc)
             torch.save(model.state_dict(), 'checkpoints/%s/best_model.t7' % args.exp_name)
+        if report is not None and not report(epoch, test_acc):
+            io.cprint('Stopped early after epoch %d' % epoch)
+            break
+    return best_test_acc
 
 
 def test(args, io):
-    test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points),
-                             batch_size=args.test_batch_size, shuffle=True, drop_last=False)
-
     device = torch.device("cuda" if args.cuda else "cpu")
 
-    model = CWNET().to(device)
+    model = build_cwnet(args.model, **model_kwargs(args)).to(device)
+    if args.auto_batch:
+        auto_batch_size(args, model, io)
+
+    test_loader = build_loader(ModelNet40(partition='test', num_points=args.num_points, sidecar=args.sidecar,
+                                          quantize=args.quantize),
+                               batch_size=args.test_batch_size, shuffle=True, drop_last=False,
+                               num_workers=args.num_workers, prefetch=args.prefetch, device=device,
+                               collate_fn=dequantize_collate if args.quantize else None)
+
     model = nn.DataParallel(model)
     model.load_state_dict(torch.load(args.model_path))
     model = model.eval()
@@ -156,12 +221,15 @@ def test(args, io):
     count = 0.0
     test_true = []
     test_pred = []
-    for data, label in test_loader:
+    for batch in test_loader:
 
-        data, label = data.to(device), label.to(device).squeeze()
+        data, label = batch[0].to(device), batch[1].to(device).squeeze()
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
-        logits = model(data)
+        if args.sidecar:
+            logits = model(data, descriptor=batch[2].to(device), xyz_idx=batch[3].to(device))
+        else:
+            logits = model(data)
         preds = logits.max(dim=1)[1]
         test_true.append(label.cpu().numpy())
         test_pred.append(preds.detach().cpu().numpy())
@@ -171,17 +239,26 @@ def test(args, io):
     avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
     outstr = 'Test :: test acc: %.6f, test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
+    io.cprint('Loader stall: %.3fs' % test_loader.stall_time)
 
 
-if __name__ == "__main__":
+def build_parser():
     # Training settings
     parser = argparse.ArgumentParser(description='3D Object Classification')
     parser.add_argument('--exp_name', type=str, default='cls', metavar='N',
                         help='Name of the experiment')
+    parser.add_argument('--model', type=str, default='cwnet', choices=sorted(CWNET_PRESETS),
+                        help='model variant, see benchmark_zoo.py for the accuracy/latency trade-off')
+    parser.add_argument('--k', type=int, default=None,
+                        help='neighbors of every stage (default: the one of --model)')
     parser.add_argument('--batch_size', type=int, default=32, metavar='batch_size',
                         help='Size of batch)')
     parser.add_argument('--test_batch_size', type=int, default=16, metavar='batch_size',
                         help='Size of batch)')
+    parser.add_argument('--auto_batch', type=bool, default=False,
+                        help='pick the largest batch sizes that fit --mem_budget')
+    parser.add_argument('--mem_budget', type=float, default=0,
+                        help='memory budget per device in GB for --auto_batch (default: 90%% of the free GPU memory)')
     parser.add_argument('--epochs', type=int, default=200, metavar='N',
                         help='number of episode to train')
     parser.add_argument('--use_sgd', type=bool, default=True,
@@ -198,9 +275,33 @@ if __name__ == "__main__":
                         help='evaluate the model')
     parser.add_argument('--num_points', type=int, default=1024,
                         help='num of points to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='data loading workers (default: -1, one per free core)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='batches prepared ahead per worker and in the prefetch queue')
+    parser.add_argument('--exits', type=int, nargs='*', default=[],
+                        help='stages with an early exit classifier, e.g. 2 3 (see early_exit.py)')
+    parser.add_argument('--exit_weight', type=float, default=0.3,
+                        help='loss weight of every early exit')
+    parser.add_argument('--val_split', type=float, default=0.0,
+                        help='fraction of the train partition held out for calibration')
+    parser.add_argument('--train_shards', type=str, default='',
+                        help='stream the training data from a sharded dataset (python -m util.shard_util)')
+    parser.add_argument('--shuffle_buffer', type=int, default=4096,
+                        help='clouds in the shuffle buffer of --train_shards')
+    parser.add_argument('--quantize', type=bool, default=False,
+                        help='keep ModelNet40 as int16 points and uint8 labels in memory')
+    parser.add_argument('--knn_probe', type=int, default=None,
+                        help='probed clusters of the approximate feature knn in stages 2-4 (default: exact knn)')
+    parser.add_argument('--sidecar', type=bool, default=False,
+                        help='evaluate with the descriptors precomputed by precompute_descriptors.py')
     parser.add_argument('--model_path', type=str, default='checkpoints/32121++/best_model.t7', metavar='N',
                         help='Pretrained model path')
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
 
     _init_()
 
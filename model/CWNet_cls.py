@@ -1,14 +1,10 @@
+import math
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
-from thop import profile
-from thop import clever_format
-from torchsummary import summary
 
-import numpy as np
-
-
-from pointnet2_ops import pointnet2_utils
+# the network only needs torch, profiling and the compiled CUDA ops are loaded
+# on demand by model/profiling.py and model/cuda_ops.py
 
 def knn(x, k):
     inner = -2*torch.matmul(x.transpose(2, 1), x)
@@ -18,6 +14,90 @@ def knn(x, k):
     idx = pairwise_distance.topk(k=k, dim=-1)[1]   # (batch_size, num_points, k)
     return idx
 
+def knn_ivf(x, k, n_probe=4, n_clusters=None, n_iter=4, block=None):
+    '''
+        approximate knn in feature space (inverted file): points are grouped by a
+        few k-means iterations, every query is reranked exactly against the points
+        of the n_probe clusters nearest to its own cluster.
+        n_probe is the recall knob, n_probe >= n_clusters falls back to exact knn.
+        The queries of a cluster are reranked in chunks of block points, clusters
+        of uneven size then cost their points times their candidates, not the
+        largest cluster times the largest candidate list for every cluster. When
+        that is still no less than N^2 (one dense blob) exact knn is used.
+        input: x, [B,C,N]
+        output: idx, [B,N,k]
+    '''
+    batch_size, num_dims, num_points = x.size()
+    n_clusters = n_clusters or max(int(num_points ** 0.5), 1)
+    block = block or max(int(math.ceil(num_points / float(n_clusters))), 1)
+    if n_probe >= n_clusters:
+        return knn(x, k=k)
+    device = x.device
+
+    x_t = x.transpose(2, 1).contiguous() # B,N,C
+    # evenly strided seeds: the same input always gives the same graph and the
+    # global RNG is left alone
+    seeds = torch.linspace(0, num_points - 1, n_clusters, device=device).long()
+    centroids = x_t[:, seeds] # B,L,C
+    ones = torch.ones(batch_size, num_points, device=device, dtype=x.dtype)
+    for _ in range(n_iter):
+        assign = square_distance(x_t, centroids).argmin(dim=-1) # B,N
+        total = torch.zeros_like(centroids).scatter_add_(1, assign.unsqueeze(-1).expand(-1, -1, num_dims), x_t)
+        count = torch.zeros_like(centroids[:, :, :1]).scatter_add_(1, assign.unsqueeze(-1), ones.unsqueeze(-1))
+        centroids = torch.where(count > 0, total / count.clamp(min=1), centroids)
+    assign = square_distance(x_t, centroids).argmin(dim=-1) # B,N
+
+    # points sorted by cluster, cluster l holds order[start[l]:start[l]+count[l]]
+    order = assign.argsort(dim=-1) # B,N
+    count = torch.zeros(batch_size, n_clusters, dtype=torch.long, device=device)
+    count.scatter_add_(1, assign, torch.ones_like(assign))
+    start = count.cumsum(-1) - count
+
+    # candidates of every cluster: the points of its n_probe nearest clusters, B,L,cap padded with -1
+    probe = square_distance(centroids, centroids).topk(k=n_probe, dim=-1, largest=False)[1] # B,L,P
+    probe_count = torch.gather(count.unsqueeze(1).expand(-1, n_clusters, -1), 2, probe)
+    probe_end = probe_count.cumsum(-1)
+    num_cand = probe_end[:, :, -1] # B,L
+    cap = max(int(num_cand.max()), k)
+    slot = torch.arange(cap, device=device).expand(batch_size, n_clusters, -1).contiguous()
+    p = torch.searchsorted(probe_end, slot, right=True).clamp(max=n_probe - 1) # B,L,cap
+    pos = torch.gather(torch.gather(start, 1, probe.view(batch_size, -1)).view_as(probe), 2, p) \
+        + slot - torch.gather(probe_end - probe_count, 2, p)
+    cand = torch.gather(order, 1, pos.clamp(0, num_points - 1).view(batch_size, -1)).view_as(pos)
+    cand = torch.where(slot < num_cand.unsqueeze(-1), cand, torch.full_like(cand, -1))
+
+    # query chunks: chunk q holds up to block points of cluster l[q], B,Q,block padded with -1
+    num_chunks = (count + block - 1) // block # B,L
+    chunk_end = num_chunks.cumsum(-1)
+    Q = int(chunk_end[:, -1].max())
+    if Q * block * cap >= num_points * num_points:
+        return knn(x, k=k)
+    q = torch.arange(Q, device=device).expand(batch_size, -1).contiguous()
+    l = torch.searchsorted(chunk_end, q, right=True).clamp(max=n_clusters - 1) # B,Q
+    offset = (q - torch.gather(chunk_end - num_chunks, 1, l)).unsqueeze(-1) * block + torch.arange(block, device=device)
+    valid = (offset < torch.gather(count, 1, l).unsqueeze(-1)) & (q < chunk_end[:, -1:]).unsqueeze(-1) # B,Q,block
+    table = torch.gather(order, 1, (torch.gather(start, 1, l).unsqueeze(-1) + offset).clamp(max=num_points - 1).view(batch_size, -1))
+    table = torch.where(valid, table.view_as(offset), torch.full_like(offset, -1))
+    cand = index_points(cand, l) # B,Q,cap
+
+    # exact rerank, one small dense block per chunk
+    queries = index_points(x_t, table.clamp(min=0)) # B,Q,block,C
+    neighbors = index_points(x_t, cand.clamp(min=0)) # B,Q,cap,C
+    dist = -2 * torch.matmul(queries, neighbors.transpose(3, 2)) # B,Q,block,cap
+    dist += torch.sum(queries ** 2, -1, keepdim=True)
+    dist += torch.sum(neighbors ** 2, -1).unsqueeze(2)
+    dist.masked_fill_((cand < 0).unsqueeze(2), float('inf'))
+    top = dist.topk(k=k, dim=-1, largest=False)[1]
+    idx = torch.gather(cand.unsqueeze(2).expand(-1, -1, block, -1), -1, top) # B,Q,block,k
+    # too few candidates: pad with the query itself
+    idx = torch.where(idx < 0, table.unsqueeze(-1).expand_as(idx), idx)
+
+    # back to point order, padded slots are written to a dummy row N
+    dest = torch.where(valid, table, torch.full_like(table, num_points))
+    out = torch.zeros(batch_size, num_points + 1, k, dtype=torch.long, device=device)
+    out.scatter_(1, dest.view(batch_size, -1, 1).expand(-1, -1, k), idx.view(batch_size, -1, k))
+    return out[:, :num_points] # B,N,k
+
 def transformer_neighbors(x, feature, k=20, idx=None):
     '''
         input: x, [B,3,N]
@@ -30,11 +110,10 @@ def transformer_neighbors(x, feature, k=20, idx=None):
     x = x.view(batch_size, -1, num_points)
     if idx is None:
         idx = knn(x, k=k)   # (batch_size, num_points, k)
-    device = torch.device('cuda')
+    device = x.device
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
-    idx_base = idx_base.type(torch.cuda.LongTensor)
-    idx = idx.type(torch.cuda.LongTensor)
+    idx = idx.long()
     idx = idx + idx_base
     idx = idx.view(-1)
  
@@ -56,6 +135,35 @@ def transformer_neighbors(x, feature, k=20, idx=None):
   
     return position_vector, neighbor_feat
 
+def softmax_weighted_sum_reference(logits, values):
+    # logits, values: B,C,N,k -> B,C,N
+    return torch.sum(F.softmax(logits, dim=-1) * values, dim=-1)
+
+
+class SoftmaxWeightedSum(torch.autograd.Function):
+    '''
+        sum_k softmax(logits)_k * values_k over the last dim.
+        only the inputs and the B,C,N output are saved, the softmax weights are
+        recomputed in backward and the temporaries are updated in place.
+    '''
+    @staticmethod
+    def forward(ctx, logits, values):
+        out = torch.softmax(logits, dim=-1).mul_(values).sum(dim=-1) # B,C,N
+        ctx.save_for_backward(logits, values, out)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        logits, values, out = ctx.saved_tensors
+        grad_values = torch.softmax(logits, dim=-1).mul_(grad_out.unsqueeze(-1)) # B,C,N,k
+        grad_logits = (values - out.unsqueeze(-1)).mul_(grad_values) # B,C,N,k
+        return grad_logits, grad_values
+
+
+def softmax_weighted_sum(logits, values):
+    return SoftmaxWeightedSum.apply(logits, values)
+
+
 class Point_Transformer(nn.Module):
     def __init__(self, input_features_dim):
         super(Point_Transformer, self).__init__()
@@ -72,10 +180,18 @@ class Point_Transformer(nn.Module):
         self.conv_gamma2 = nn.Conv2d(input_features_dim, input_features_dim, 1)
         self.bn_conv_gamma = nn.BatchNorm2d(input_features_dim)
 
-    def forward(self, xyz, features, k):
+    def forward(self, xyz, features, k, idx=None):
 
-        position_vector, x_j = transformer_neighbors(xyz, features, k=k)
+        position_vector, x_j = transformer_neighbors(xyz, features, k=k, idx=idx)
+        return self.aggregate(position_vector, features, x_j)
 
+    def aggregate(self, position_vector, features, x_j):
+        '''
+            input: position_vector, [B,3,N,k] center minus neighbor xyz
+                   features, [B,C,N] center features
+                   x_j, [B,C,N,k] neighbor features
+        '''
+        k = x_j.size(-1)
         delta = F.relu(self.bn_conv_theta(self.conv_theta2(self.conv_theta1(position_vector)))) # B,C,N,k
         # corrections for x_i
         x_i = torch.unsqueeze(features, dim=-1).repeat(1, 1, 1, k) # B,C,N,k
@@ -87,21 +203,22 @@ class Point_Transformer(nn.Module):
         relation_x = linear_x_i - linear_x_j + delta # B,C,N,k
         relation_x = F.relu(self.bn_conv_gamma(self.conv_gamma2(self.conv_gamma1(relation_x)))) # B,C,N,k
 
-        weights = F.softmax(relation_x, dim=-1) # B,C,N,k
         features = self.conv_alpha(x_j) + delta # B,C,N,k
 
-        f_out = weights * features # B,C,N,k
-        f_out = torch.sum(f_out, dim=-1) # B,C,N
+        f_out = softmax_weighted_sum(relation_x, features) # B,C,N
 
         return f_out
 
-def get_graph_feature(x, k, idx=None):#B, C, N----B, 2*C, N, k
+def get_graph_feature(x, k, idx=None, n_probe=None):#B, C, N----B, 2*C, N, k
     batch_size = x.size(0)
     num_points = x.size(2)
     x = x.view(batch_size, -1, num_points)
     if idx is None:
-        idx = knn(x, k=k)   # (batch_size, num_points, k)
-    device = torch.device('cpu')
+        if n_probe is None:
+            idx = knn(x, k=k)   # (batch_size, num_points, k)
+        else:
+            idx = knn_ivf(x, k=k, n_probe=n_probe)
+    device = x.device
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
 
@@ -129,11 +246,10 @@ def geometric_point_descriptor(x, k=3, idx=None):
     x = x.view(batch_size, -1, num_points)
     if idx is None:
         idx = knn(x, k=k)  # (batch_size, num_points, k)
-    device = torch.device('cuda')
+    device = x.device
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
-    idx_base = idx_base.type(torch.cuda.LongTensor)
-    idx = idx.type(torch.cuda.LongTensor)
+    idx = idx.long()
     idx = idx + idx_base
     idx = idx.view(-1)
 
@@ -144,11 +260,14 @@ def geometric_point_descriptor(x, k=3, idx=None):
     neighbors = neighbors.view(batch_size, num_points, k, num_dims)
 
     neighbors = neighbors.permute(0, 3, 1, 2)  # B,C,N,k
-    neighbor_1st = torch.index_select(neighbors, dim=-1, index=torch.cuda.LongTensor([1])) # B,C,N,1
+    neighbor_1st = torch.index_select(neighbors, dim=-1, index=torch.tensor([1], device=device)) # B,C,N,1
     neighbor_1st = torch.squeeze(neighbor_1st, -1)  # B,3,N
-    neighbor_2nd = torch.index_select(neighbors, dim=-1, index=torch.cuda.LongTensor([2])) # B,C,N,1
+    neighbor_2nd = torch.index_select(neighbors, dim=-1, index=torch.tensor([2], device=device)) # B,C,N,1
     neighbor_2nd = torch.squeeze(neighbor_2nd, -1)  # B,3,N
+    return point_descriptor(org_x, neighbor_1st, neighbor_2nd)
 
+def point_descriptor(org_x, neighbor_1st, neighbor_2nd):
+    # B,3,N points and their two nearest neighbors -> B,8,N
     edge1 = neighbor_1st-org_x
     edge2 = neighbor_2nd-org_x
     normals = torch.cross(edge1, edge2, dim=1) # B,3,N
@@ -169,38 +288,29 @@ def pw_dist(x):
 
 
 def knn_metric(x, d, conv_op1, conv_op2, conv_op11, k):
-    batch_size = x.size(0)
-    num_points = x.size(2)
+    '''
+        adaptive dilated knn: one topk finds the d*k nearest neighbors, a small
+        network on their distances predicts a dilation rate in 1..d per point
+        and every rate-th neighbor is kept.
+        input: x, [B,C,N]
+        output: idx, [B,N,k]
+    '''
     inner = -2 * torch.matmul(x.transpose(2, 1), x)
     xx = torch.sum(x ** 2, dim=1, keepdim=True)
     pairwise_distance = -xx - inner - xx.transpose(2, 1)
 
-    metric = (-pairwise_distance).topk(k=d * k, dim=-1, largest=False)[0]  # B,N,100
-    metric_idx = (-pairwise_distance).topk(k=d * k, dim=-1, largest=False)[1]  # B,N,100
-    metric_trans = metric.permute(0, 2, 1)  # B,100,N
-    metric = conv_op1(metric_trans)  # B,50,N
+    metric, idx = pairwise_distance.topk(k=d * k, dim=-1)  # B,N,d*k nearest first
+    metric_trans = -metric.permute(0, 2, 1)  # B,d*k,N squared distances
+    metric = conv_op1(metric_trans)  # B,d*k/2,N
     metric = torch.squeeze(conv_op11(metric).permute(0, 2, 1), -1)  # B,N
     # normalize function
     metric = torch.sigmoid(-metric)
     # projection function
-    metric = 5 * metric + 0.5
-    # scaling function
-
-    value1 = torch.where((metric >= 0.5) & (metric < 1.5), torch.full_like(metric, 1), torch.full_like(metric, 0))
-    value2 = torch.where((metric >= 1.5) & (metric < 2.5), torch.full_like(metric, 2), torch.full_like(metric, 0))
-    value3 = torch.where((metric >= 2.5) & (metric < 3.5), torch.full_like(metric, 3), torch.full_like(metric, 0))
-    value4 = torch.where((metric >= 3.5) & (metric < 4.5), torch.full_like(metric, 4), torch.full_like(metric, 0))
-    value5 = torch.where((metric >= 4.5) & (metric <= 5.5), torch.full_like(metric, 5), torch.full_like(metric, 0))
-
-    value = value1 + value2 + value3 + value4 + value5 # B,N
-
-    select_idx = torch.cuda.LongTensor(np.arange(k))  # k
-    select_idx = torch.unsqueeze(select_idx, 0).repeat(num_points, 1)  # N,k
-    select_idx = torch.unsqueeze(select_idx, 0).repeat(batch_size, 1, 1)  # B,N,k
-    value = torch.unsqueeze(value, -1).repeat(1, 1, k)  # B,N,k
-    select_idx = select_idx * value
-    select_idx = select_idx.long()
-    idx = pairwise_distance.topk(k=k * d, dim=-1)[1]  # (batch_size, num_points, k*d)
+    metric = d * metric + 0.5
+    # scaling function: rate r for metric in [r-0.5, r+0.5)
+    value = torch.floor(metric + 0.5).clamp(1, d).long()  # B,N
+
+    select_idx = torch.arange(k, device=x.device) * value.unsqueeze(-1)  # B,N,k
     # dilatedly selecting k from k*d idx
     idx = torch.gather(idx, dim=-1, index=select_idx)  # B,N,k
     return idx
@@ -213,11 +323,10 @@ def get_adptive_dilated_graph_feature(x, conv_op1, conv_op2, conv_op11, d=5, k=2
     x = x.view(batch_size, -1, num_points)
     if idx is None:
         idx = knn_metric(x, d, conv_op1, conv_op2, conv_op11, k=k)  # (batch_size, num_points, k)
-    device = torch.device('cuda')
+    device = x.device
     idx_base = torch.arange(0, batch_size, device=device)
     idx_base = idx_base.view(-1, 1, 1) * num_points
-    idx_base = idx_base.type(torch.cuda.LongTensor)
-    idx = idx.type(torch.cuda.LongTensor)
+    idx = idx.long()
     idx = idx + idx_base
     idx = idx.view(-1)
     _, num_dims, _ = x.size()
@@ -372,14 +481,17 @@ class Trans2(nn.Module):
         
 
     def forward(self, x):
-        # b, n, c
+        return self.attend(x, x)
+
+    def attend(self, x, context):
+        # queries x: b, m, c over keys and values of context: b, n, c
         B,N,C = x.shape
         x_q = self.q_layer(x)#b,n,c
         # b, c, n
-        x_k = self.k_layer(x).permute(0,2,1)#b,c,n
-        x_v = self.v_layer(x)#b,n,c
+        x_k = self.k_layer(context).permute(0,2,1)#b,c,n
+        x_v = self.v_layer(context)#b,n,c
         if self.transform == 'SS':
-            att = self.softmax(torch.divide(torch.matmul(x_q, x_k),np.sqrt(self.dk)))
+            att = self.softmax(torch.divide(torch.matmul(x_q, x_k),math.sqrt(self.dk)))
         elif self.transform == 'SL':
             QK = torch.matmul(x_q, x_k)
             att = torch.divide(self.softmax(QK),QK.sum(dim=2).view(B,-1,1))
@@ -390,36 +502,51 @@ class Trans2(nn.Module):
         return f
   
   
-class CWNET(nn.Module):
-    def __init__(self):
-        super(GDANET, self).__init__()
-        
-        self.pointrans1 =Point_Transformer(64) 
-        self.pointrans2 =Point_Transformer(64)
-        self.pointrans3 =Point_Transformer(128)
-        self.pointrans4 =Point_Transformer(256)
-        
+CWNET_PRESETS = {
+    # name: constructor arguments, 'cwnet' is the configuration of the paper
+    'cwnet': dict(),
+    'cwnet_k16': dict(k=16),
+    'cwnet_s': dict(width_mult=0.5, emb_dims=512),
+    'cwnet_xs': dict(width_mult=0.5, num_stages=3, k=(20, 16, 16), emb_dims=512),
+    'cwnet_xxs': dict(width_mult=0.25, num_stages=3, k=(16, 10, 10), emb_dims=256),
+}
+
+# modules of the original checkpoints that forward never used
+LEGACY_MODULES = ('pointrans2', 'pointrans3', 'pointrans4', 'pt1', 'dfa1')
+
+
+def build_cwnet(name='cwnet', **kwargs):
+    cfg = dict(CWNET_PRESETS[name])
+    cfg.update(kwargs)
+    return CWNET(**cfg)
 
-        self.pt1 = Trans2(64,transform='SS')
-        self.pt2 = Trans2(64,transform='SS')
-        self.pt3 = Trans2(128,transform='SS')
-        self.pt4 = Trans2(256,transform='SS')
+
+class CWNET(nn.Module):
+    def __init__(self, widths=(64, 64, 128, 256), width_mult=1.0, num_stages=None, k=20,
+                 emb_dims=1024, num_classes=40, knn_probe=None, exits=()):
+        super(CWNET, self).__init__()
+        widths = [max(8, int(round(w * width_mult))) for w in widths[:num_stages]]
+        self.widths = widths
+        self.num_stages = len(widths)
+        # neighbors of every stage
+        self.k = list(k) if isinstance(k, (list, tuple)) else [k] * self.num_stages
+        assert len(self.k) == self.num_stages, 'one k per stage'
+        # probed clusters of the approximate feature knn in stages 2-4, None for exact knn
+        self.knn_probe = knn_probe
         
-        self.dc1 = deepconv(16, 64, 16)
-        self.dc2 = deepconv(128, 64, 128)
-        self.dc3 = deepconv(128, 128, 128)
-        self.dc4 = deepconv(256, 256, 256)
+        self.dc1 = deepconv(16, widths[0], 16)
+        self.pointrans1 = Point_Transformer(widths[0])
+        for i in range(1, self.num_stages):
+            setattr(self, 'dc%d' % (i + 1), deepconv(2 * widths[i - 1], widths[i], 2 * widths[i - 1]))
+            setattr(self, 'pt%d' % (i + 1), Trans2(widths[i], transform='SS'))
+            setattr(self, 'dfa%d' % (i + 1), DFA(features=widths[i], M=2, r=1))
         
-        self.out = nn.Sequential(nn.Conv1d(512, 1024, 1),
-                                 nn.BatchNorm1d(1024),
+        self.out = nn.Sequential(nn.Conv1d(sum(widths), emb_dims, 1),
+                                 nn.BatchNorm1d(emb_dims),
                                  nn.LeakyReLU(0.2))
  
-
- 
-    
- 
         self.classifier = nn.Sequential(
-                                        nn.Linear(1024*2, 512),
+                                        nn.Linear(emb_dims*2, 512),
                                         nn.BatchNorm1d(512),
                                         nn.LeakyReLU(negative_slope=0.2),
                                         nn.Dropout(0.5),
@@ -427,52 +554,55 @@ class CWNET(nn.Module):
                                         nn.BatchNorm1d(256),
                                         nn.LeakyReLU(negative_slope=0.2),
                                         nn.Dropout(0.5),
-                                        nn.Linear(256, 40)
+                                        nn.Linear(256, num_classes)
                                         )
-        
 
-        
-        self.dfa1 = DFA(features=64,M=2,r=1)
-        self.dfa2 = DFA(features=64,M=2,r=1)
-        self.dfa3 = DFA(features=128,M=2,r=1)
-        self.dfa4 = DFA(features=256,M=2,r=1)
+        # early exit classifiers on the pooled features of intermediate stages
+        self.exits = sorted(exits)
+        assert all(1 <= i < self.num_stages for i in self.exits), 'exits after stages 1..num_stages-1'
+        for i in self.exits:
+            setattr(self, 'exit%d' % i, nn.Sequential(
+                                        nn.Linear(widths[i - 1]*2, 256),
+                                        nn.BatchNorm1d(256),
+                                        nn.LeakyReLU(negative_slope=0.2),
+                                        nn.Dropout(0.5),
+                                        nn.Linear(256, num_classes)
+                                        ))
 
-       
-    
+        self._register_load_state_dict_pre_hook(self._drop_legacy_keys)
 
-    def forward(self, x):
-        B, C, N = x.size()
-        xyz = x 
-        
-        x = geometric_point_descriptor(x)
-        # x = self.embedding(x)#B 32 N
+    def _drop_legacy_keys(self, state_dict, prefix, *args):
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix) and key[len(prefix):].split('.')[0] in LEGACY_MODULES:
+                del state_dict[key]
+
+    def stage1(self, xyz, descriptor=None, xyz_idx=None):
+        if descriptor is None:
+            x = geometric_point_descriptor(xyz)
+        else:
+            x = descriptor
       
-        x1 = get_graph_feature(x, k=20)
+        x1 = get_graph_feature(x, k=self.k[0])
         x1 = self.dc1(x1)
-        x1_t = self.pointrans1(xyz,x1,k=20)
-        # print(x1_t.shape)
-        
-        x2 = get_graph_feature(x1_t, k=20)
-        x2 = self.dc2(x2)
-        x2s = x2.permute(0,2,1)
-        x2s = self.pt2(x2s)
-        x2_t = self.dfa2([x2,x2s.permute(0,2,1)])
-
-        
-        x3 = get_graph_feature(x2_t, k=20)
-        x3 = self.dc3(x3)
-        x3s = x3.permute(0,2,1)
-        x3s = self.pt3(x3s)
-        x3_t = self.dfa3([x3,x3s.permute(0,2,1)])
-        
-        x4 = get_graph_feature(x3_t, k=20)
-        x4 = self.dc4(x4)
-        x4s = x4.permute(0,2,1)
-        x4s = self.pt4(x4s)
-        x4_t = self.dfa4([x4,x4s.permute(0,2,1)])
-
-        
-        x = torch.cat((x1_t,x2_t,x3_t,x4_t),dim=1)
+        x1_t = self.pointrans1(xyz,x1,k=self.k[0],idx=None if xyz_idx is None else xyz_idx[:, :, :self.k[0]])
+        return x1_t
+
+    def stage(self, i, x):
+        # stages 2..num_stages, B,C_{i-1},N -> B,C_i,N
+        xi = get_graph_feature(x, k=self.k[i - 1], n_probe=self.knn_probe)
+        xi = getattr(self, 'dc%d' % i)(xi)
+        xis = getattr(self, 'pt%d' % i)(xi.permute(0,2,1))
+        xi_t = getattr(self, 'dfa%d' % i)([xi,xis.permute(0,2,1)])
+        return xi_t
+
+    def exit_head(self, i, x):
+        x = torch.cat((F.adaptive_avg_pool1d(x,1).squeeze(-1), F.adaptive_max_pool1d(x,1).squeeze(-1)),dim=-1)
+        return getattr(self, 'exit%d' % i)(x)
+
+    def pool(self, stages):
+        # global shape descriptor, B,2*emb_dims
+        B = stages[0].size(0)
+        x = torch.cat(stages,dim=1)
         
         x = self.out(x)
         
@@ -480,23 +610,61 @@ class CWNET(nn.Module):
         x12 = F.adaptive_max_pool1d(x,1).view(B,-1)
         
         x = torch.cat((x11,x12),dim=-1)
-        x = self.classifier(x)
+        return x
+
+    def head(self, stages):
+        return self.classifier(self.pool(stages))
+
+    def forward(self, x, descriptor=None, xyz_idx=None, return_exits=False, return_embedding=False):
+        # descriptor: B,8,N and xyz_idx: B,N,k>=20 precomputed by precompute_descriptors.py
+        # return_exits: also return the logits of the early exits, for training them jointly
+        # return_embedding: return the pooled B,2*emb_dims features instead of the logits
+        stages = [self.stage1(x, descriptor, xyz_idx)]
+        for i in range(2, self.num_stages + 1):
+            stages.append(self.stage(i, stages[-1]))
         
-    
+        if return_embedding:
+            return self.pool(stages)
+        x = self.head(stages)
+        
+        if return_exits:
+            return x, [self.exit_head(i, stages[i - 1]) for i in self.exits]
         return x
 
-# if __name__ == '__main__':
-#     data_size = (1,3,1024)
-#     data = torch.randn(data_size)
-#     model = GDANET()
-#     print("===> testing pointMLP ...")
-#     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-#     model.to(device)
-#     summary(model, input_size=data_size)
-#     # flops = torch.cuda.get_flops(model, input_size=data_size)
-#     # print("Total FLOPs:", flops)
-#     # flops, params = profile(model, inputs=(data),verbose=False)
-#     # flops, params = clever_format([flops,params])
-#     # out = model(data)
-#     # print(f'FLOPs:{flops}')
-#     # print(f'Params:{params}')
+    def embed(self, x, descriptor=None, xyz_idx=None):
+        return self.forward(x, descriptor, xyz_idx, return_embedding=True)
+
+    def forward_early_exit(self, x, thresholds, descriptor=None, xyz_idx=None):
+        '''
+            stops every cloud at the first exit whose max softmax probability
+            reaches thresholds[i] (one per exit), the rest run the whole network.
+            output: logits, [B,num_classes]
+                    exit_stage, [B] stage of the exit, num_stages for the full network
+        '''
+        B = x.size(0)
+        active = torch.arange(B, device=x.device)
+        logits = None
+        exit_stage = torch.full((B,), self.num_stages, dtype=torch.long, device=x.device)
+
+        stages = [self.stage1(x, descriptor, xyz_idx)]
+        for i in range(1, self.num_stages + 1):
+            if i > 1:
+                stages.append(self.stage(i, stages[-1]))
+            if i not in self.exits:
+                continue
+            out = self.exit_head(i, stages[-1])
+            if logits is None:
+                logits = out.new_zeros(B, out.size(1))
+            done = F.softmax(out, dim=-1).max(dim=-1)[0] >= thresholds[self.exits.index(i)]
+            logits[active[done]] = out[done]
+            exit_stage[active[done]] = i
+            active = active[~done]
+            stages = [s[~done] for s in stages]
+            if active.numel() == 0:
+                return logits, exit_stage
+
+        out = self.head(stages)
+        if logits is None:
+            return out, exit_stage
+        logits[active] = out
+        return logits, exit_stage
@@ -0,0 +1,28 @@
+_pointnet2_utils = None
+
+
+def pointnet2_utils():
+    # the compiled pointnet2_ops extension, imported on first use, None if it is not installed
+    global _pointnet2_utils
+    if _pointnet2_utils is None:
+        try:
+            from pointnet2_ops import pointnet2_utils as ops
+        except ImportError:
+            ops = False
+        _pointnet2_utils = ops
+    return _pointnet2_utils or None
+
+
+def furthest_point_sample(xyz, npoint):
+    """
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+    """
+    ops = pointnet2_utils() if xyz.is_cuda else None
+    if ops is not None:
+        return ops.furthest_point_sample(xyz.contiguous(), npoint).long()
+    from model.CWNet_cls import farthest_point_sample
+    return farthest_point_sample(xyz, npoint)
@@ -0,0 +1,30 @@
+import torch
+
+
+def profile(model, data):
+    # FLOPs and parameters with thop, imported only when profiling
+    from thop import profile as thop_profile
+    from thop import clever_format
+    flops, params = thop_profile(model, inputs=(data,), verbose=False)
+    return clever_format([flops, params])
+
+
+def summary(model, input_size, device='cuda'):
+    # layer-by-layer summary with torchsummary, imported only when asked for
+    from torchsummary import summary as torch_summary
+    torch_summary(model, input_size=input_size, device=device)
+
+
+if __name__ == '__main__':
+    import sys
+    import os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from model.CWNet_cls import CWNET
+
+    data_size = (1, 3, 1024)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = CWNET().to(device).eval()
+    summary(model, input_size=data_size[1:], device=device.type)
+    flops, params = profile(model, torch.randn(data_size, device=device))
+    print(f'FLOPs:{flops}')
+    print(f'Params:{params}')
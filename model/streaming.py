@@ -0,0 +1,257 @@
+import torch
+from model.CWNet_cls import point_descriptor
+
+
+def square_dist(a, b):
+    # a: M,D  b: N,D -> M,N
+    return torch.sum(a ** 2, dim=1, keepdim=True) - 2 * torch.matmul(a, b.t()) + torch.sum(b ** 2, dim=1).view(1, -1)
+
+
+def list_changed(idx, prev, m):
+    # points whose first m neighbors differ from prev, the points appended since are changed
+    changed = torch.ones(idx.size(0), dtype=torch.bool, device=idx.device)
+    changed[:prev.size(0)] = (idx[:prev.size(0), :m] != prev[:, :m]).any(dim=1)
+    return changed
+
+
+class KNNGraph():
+    '''
+        k nearest neighbors (nearest first, the point itself included) of a
+        growing point set. After points are added or moved only the lists that
+        can have changed are recomputed: those of the moved points and those that
+        contained one, the others merge their list with the moved points unless
+        those are all farther than their k-th neighbor.
+    '''
+    def __init__(self, k, dims, device):
+        self.k = k
+        self.x = torch.zeros(0, dims, device=device)  # N,D
+        self.idx = torch.zeros(0, k, dtype=torch.long, device=device)  # N,k
+        self.dist = torch.zeros(0, k, device=device)  # N,k squared distances
+
+    def __len__(self):
+        return self.x.size(0)
+
+    def add(self, values):
+        n = len(self)
+        self.x = torch.cat((self.x, values), dim=0)
+        self.idx = torch.cat((self.idx, self.idx.new_zeros(len(values), self.k)), dim=0)
+        self.dist = torch.cat((self.dist, self.dist.new_zeros(len(values), self.k)), dim=0)
+        return torch.arange(n, len(self), device=self.x.device)
+
+    def refresh(self, rows):
+        # rows: [M] points added or moved since the last refresh
+        if len(rows) == 0:
+            return
+        moved = torch.zeros(len(self), dtype=torch.bool, device=self.x.device)
+        moved[rows] = True
+        full = moved | moved[self.idx].any(dim=1)
+        full_rows = full.nonzero().view(-1)
+        dist = square_dist(self.x[full_rows], self.x)
+        self.dist[full_rows], self.idx[full_rows] = dist.topk(self.k, dim=1, largest=False)
+
+        # the other lists can only take a moved point closer than their k-th
+        # neighbor, none can if the bounding box of the moved points is farther
+        x = self.x[rows]
+        lo, hi = x.min(dim=0)[0], x.max(dim=0)[0]
+        gap = torch.sum((lo - self.x).clamp(min=0) ** 2 + (self.x - hi).clamp(min=0) ** 2, dim=1)
+        rest = (~full & (gap < self.dist[:, -1])).nonzero().view(-1)
+        if len(rest):
+            dist = torch.cat((self.dist[rest], square_dist(self.x[rest], x)), dim=1)
+            idx = torch.cat((self.idx[rest], rows.view(1, -1).expand(len(rest), -1)), dim=1)
+            dist, top = dist.topk(self.k, dim=1, largest=False)
+            self.dist[rest], self.idx[rest] = dist, torch.gather(idx, 1, top)
+
+
+def grow(cache, values, n):
+    # C,N cache of per-point features -> C,n, the new columns are filled by the caller
+    if cache is None:
+        cache = values.new_zeros(values.size(0), 0)
+    if cache.size(1) < n:
+        cache = torch.cat((cache, cache.new_zeros(cache.size(0), n - cache.size(1))), dim=1)
+    return cache
+
+
+class StreamingClassifier():
+    '''
+        CWNET on a cloud that grows frame by frame (eval mode, one cloud).
+        Stage 1 is exact and local: the xyz and descriptor knn graphs are kept
+        and only the descriptors, dc1 and pointrans1 features of the points whose
+        neighborhoods changed are recomputed. Stages 2.. are not local, their knn
+        is in feature space and Trans2 attends over all points, so only the
+        changed points are recomputed against the cached features of the others
+        and the whole deep part is re-run once the points added or moved (other
+        two nearest neighbors) since the last exact pass are more than `refresh`
+        of the cloud.
+    '''
+    def __init__(self, model, refresh=0.3):
+        assert not model.training, 'BatchNorm must use its running statistics'
+        self.model = model
+        self.refresh = refresh
+        self.device = next(model.parameters()).device
+        self.reset()
+
+    def reset(self):
+        k = self.model.k[0]
+        self.xyz = KNNGraph(max(3, k), 3, self.device)
+        self.desc = KNNGraph(k, 8, self.device)
+        self.buffer = []  # points until the cloud has enough for the largest k
+        self.features = [None] * self.model.num_stages  # C_i,N output of every stage
+        self.dc = [None] * self.model.num_stages  # C_i,N deepconv output, the context of Trans2
+        self.emb = None  # emb_dims,N
+        self.stale = None  # points added or moved since the last exact pass of stages 2..
+        self.stats = dict(frames=0, exact=0, stage1=0, deep=0)
+
+    def __len__(self):
+        return len(self.xyz) + sum(len(b) for b in self.buffer)
+
+    def insert(self, points):
+        '''
+            input: points, [M,3] new points of the cloud
+            output: logits, [num_classes] for the whole cloud so far, None while it
+                    has fewer points than the largest k
+        '''
+        points = torch.as_tensor(points, dtype=torch.float32).to(self.device).view(-1, 3)
+        self.buffer.append(points)
+        if len(self) < max(self.model.k):
+            return None
+        points = torch.cat(self.buffer, dim=0)
+        self.buffer = []
+        self.stats['frames'] += 1
+        with torch.no_grad():
+            moved, changed = self._stage1(points)
+            return self._deep(moved, changed)
+
+    def _stage1(self, points):
+        model, k = self.model, self.model.k[0]
+        prev = self.xyz.idx.clone()
+        self.xyz.refresh(self.xyz.add(points))
+        N = len(self.xyz)
+
+        # descriptors of the points whose two nearest neighbors changed
+        moved = list_changed(self.xyz.idx, prev, 3)
+        rows = moved.nonzero().view(-1)
+        nbr = self.xyz.idx[rows]
+        desc = point_descriptor(self.xyz.x[rows].t()[None], self.xyz.x[nbr[:, 1]].t()[None],
+                                self.xyz.x[nbr[:, 2]].t()[None])[0].t()  # M,8
+        prev_desc = self.desc.idx.clone()
+        n_old = len(self.desc)
+        self.desc.x[rows[rows < n_old]] = desc[rows < n_old]
+        self.desc.add(desc[rows >= n_old])
+        self.desc.refresh(rows)
+
+        # dc1 on the descriptor graph feature of the points whose neighborhood changed
+        a1 = moved | list_changed(self.desc.idx, prev_desc, k) | moved[self.desc.idx].any(dim=1)
+        rows = a1.nonzero().view(-1)
+        x_j = self.desc.x[self.desc.idx[rows]]  # M,k,8
+        x_i = self.desc.x[rows].unsqueeze(1).expand(-1, k, -1)
+        graph = torch.cat((x_j - x_i, x_i), dim=2).permute(2, 0, 1).unsqueeze(0)  # 1,16,M,k
+        out = model.dc1(graph)[0]
+        self.dc[0] = grow(self.dc[0], out, N)
+        self.dc[0][:, rows] = out
+
+        # pointrans1 over the xyz neighbors
+        a2 = a1 | a1[self.xyz.idx[:, :k]].any(dim=1) | list_changed(self.xyz.idx, prev, k)
+        rows = a2.nonzero().view(-1)
+        idx = self.xyz.idx[rows, :k]
+        position_vector = (self.xyz.x[rows].unsqueeze(1) - self.xyz.x[idx]).permute(2, 0, 1).unsqueeze(0)
+        x_j = self.dc[0][:, idx].unsqueeze(0)  # 1,C,M,k
+        out = model.pointrans1.aggregate(position_vector, self.dc[0][:, rows].unsqueeze(0), x_j)[0]
+        self.features[0] = grow(self.features[0], out, N)
+        self.features[0][:, rows] = out
+        self.stats['stage1'] += len(rows)
+        return moved, a2
+
+    def _deep(self, moved, changed):
+        # moved: points added or with other two nearest neighbors, changed: points with new stage 1 features
+        model = self.model
+        N = len(self.xyz)
+        stale = moved.clone()
+        if self.stale is not None:
+            stale[:len(self.stale)] |= self.stale
+        exact = self.emb is None or stale.float().mean().item() > self.refresh
+        self.stale = torch.zeros_like(stale) if exact else stale
+        if exact:
+            self.stats['exact'] += 1
+            changed = torch.ones_like(changed)
+        rows = changed.nonzero().view(-1)
+
+        for i in range(2, model.num_stages + 1):
+            x, k = self.features[i - 2], model.k[i - 1]
+            q = x[:, rows]
+            idx = square_dist(q.t(), x.t()).topk(k, dim=1, largest=False)[1]  # M,k
+            x_i = q.unsqueeze(-1).expand(-1, -1, k)
+            graph = torch.cat((x[:, idx] - x_i, x_i), dim=0).unsqueeze(0)  # 1,2C,M,k
+            dc = getattr(model, 'dc%d' % i)(graph)  # 1,C_i,M
+            self.dc[i - 1] = grow(self.dc[i - 1], dc[0], N)
+            self.dc[i - 1][:, rows] = dc[0]
+            att = getattr(model, 'pt%d' % i).attend(dc.permute(0, 2, 1), self.dc[i - 1].t().unsqueeze(0))
+            out = getattr(model, 'dfa%d' % i)([dc, att.permute(0, 2, 1)])[0]
+            self.features[i - 1] = grow(self.features[i - 1], out, N)
+            self.features[i - 1][:, rows] = out
+        self.stats['deep'] += len(rows)
+
+        emb = model.out(torch.cat([f[:, rows] for f in self.features], dim=0).unsqueeze(0))[0]
+        self.emb = grow(self.emb, emb, N)
+        self.emb[:, rows] = emb
+        pooled = torch.cat((self.emb.mean(dim=1), self.emb.max(dim=1)[0])).unsqueeze(0)
+        return model.classifier(pooled)[0]
+
+
+if __name__ == '__main__':
+    import sys
+    import os
+    import time
+    import argparse
+    import torch.nn as nn
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from model.CWNet_cls import build_cwnet, CWNET_PRESETS
+    from util.data_util import load_data
+
+    parser = argparse.ArgumentParser(description='Replay ModelNet40 test clouds as streams of frames')
+    parser.add_argument('--model', type=str, default='cwnet', choices=sorted(CWNET_PRESETS),
+                        help='model variant')
+    parser.add_argument('--model_path', type=str, default='checkpoints/cls/best_model.t7',
+                        help='Pretrained model path')
+    parser.add_argument('--num_points', type=int, default=2048,
+                        help='points of every cloud at the end of the stream')
+    parser.add_argument('--frames', type=int, default=16,
+                        help='frames every cloud arrives in, as slabs along x')
+    parser.add_argument('--refresh', type=float, default=0.3,
+                        help='fraction of the points added or moved that triggers an exact pass of stages 2..')
+    parser.add_argument('--clouds', type=int, default=50,
+                        help='test clouds to replay')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = nn.DataParallel(build_cwnet(args.model).to(device))
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    net = model.module.eval()
+    streaming = StreamingClassifier(net, refresh=args.refresh)
+
+    data, _ = load_data('test')
+    t_stream = t_full = 0.0
+    agree = total = exact = 0
+    for cloud in data[:args.clouds]:
+        cloud = torch.from_numpy(cloud[:args.num_points]).to(device)
+        cloud = cloud[cloud[:, 0].argsort()]  # a scanner sweeping along x
+        streaming.reset()
+        for frame in cloud.chunk(args.frames):
+            start = time.time()
+            logits = streaming.insert(frame)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            t_stream += time.time() - start
+            if logits is None:
+                continue
+            start = time.time()
+            with torch.no_grad():
+                full = net(streaming.xyz.x.t().unsqueeze(0))[0]
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            t_full += time.time() - start
+            agree += int(logits.argmax() == full.argmax())
+            total += 1
+        exact += streaming.stats['exact']
+    print('%d frames: streaming %.2f ms/frame, full forward %.2f ms/frame, same class %.4f, exact passes %d'
+          % (total, t_stream * 1000 / total, t_full * 1000 / total, agree / float(total),
+             exact))
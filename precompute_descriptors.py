@@ -0,0 +1,46 @@
+from __future__ import print_function
+import argparse
+import h5py
+import torch
+from util.data_util import load_data, sidecar_path
+from model.CWNet_cls import knn, geometric_point_descriptor
+
+
+def precompute(partition, num_points, k, batch_size, device):
+    data, _ = load_data(partition)
+    data = data[:, :num_points]
+    num_clouds = data.shape[0]
+
+    f = h5py.File(sidecar_path(partition, num_points), 'w')
+    descriptor = f.create_dataset('descriptor', (num_clouds, 8, num_points), dtype='float32')
+    knn_idx = f.create_dataset('knn_idx', (num_clouds, num_points, k),
+                               dtype='int16' if num_points <= 32767 else 'int32')
+    f.attrs['num_points'] = num_points
+    f.attrs['k'] = k
+
+    with torch.no_grad():
+        for i in range(0, num_clouds, batch_size):
+            xyz = torch.from_numpy(data[i:i + batch_size]).to(device).permute(0, 2, 1)  # B,3,N
+            idx = knn(xyz, k=k)  # B,N,k, sorted so the first 3 are the descriptor neighbors
+            descriptor[i:i + batch_size] = geometric_point_descriptor(xyz, idx=idx[:, :, :3]).cpu().numpy()
+            knn_idx[i:i + batch_size] = idx.cpu().numpy()
+    f.close()
+    print('%s: %d clouds -> %s' % (partition, num_clouds, sidecar_path(partition, num_points)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precompute geometric descriptors and xyz knn of ModelNet40')
+    parser.add_argument('--partition', type=str, default='test',
+                        help='dataset partition, only un-augmented partitions can use the sidecar')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--k', type=int, default=20,
+                        help='num of xyz nearest neighbors to store')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Size of batch)')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    precompute(args.partition, args.num_points, args.k, args.batch_size, device)
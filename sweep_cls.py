@@ -0,0 +1,179 @@
+from __future__ import print_function
+import os
+import csv
+import copy
+import time
+import argparse
+import itertools
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from util.data_util import ModelNet40, DATASET_ARRAYS
+from util.util import IOStream
+import main_cls
+
+
+# set in every pool process by init_worker
+_datasets = {}
+_history = None
+_sweep = None
+
+
+def detach_arrays(dataset):
+    # the arrays go to shared memory tensors, the dataset object left is small to pickle
+    tensors = {}
+    for name in DATASET_ARRAYS:
+        array = getattr(dataset, name, None)
+        if isinstance(array, np.ndarray):
+            tensors[name] = torch.from_numpy(np.ascontiguousarray(array)).share_memory_()
+            setattr(dataset, name, None)
+    return dataset, tensors
+
+
+def attach_arrays(dataset, tensors):
+    for name, tensor in tensors.items():
+        setattr(dataset, name, tensor.numpy())
+    dataset.shared_memory = True  # build_loader must not copy them again
+    return dataset
+
+
+def init_worker(datasets, history, slots, threads, gpus, sweep):
+    global _datasets, _history, _sweep
+    _datasets = {name: attach_arrays(dataset, tensors) for name, (dataset, tensors) in datasets.items()}
+    _history = history
+    _sweep = sweep
+    torch.set_num_threads(threads)
+    slot = slots.get()
+    if gpus > 0:
+        # one GPU per pool process, before anything initializes CUDA
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(slot % gpus)
+
+
+def median_stop(trial, epoch, best, grace, min_trials):
+    '''
+        median stopping rule: after the grace epochs a trial stops when its best
+        accuracy so far is below the median of the other trials at the same epoch.
+    '''
+    curves = [h for t, h in _history.items() if t != trial and len(h) > epoch]
+    if epoch < grace or len(curves) < min_trials:
+        return False
+    return best < np.median([max(h[:epoch + 1]) for h in curves])
+
+
+def run_trial(trial, args):
+    start = time.time()
+    args.exp_name = '%s/trial%03d' % (_sweep.sweep_name, trial)
+    if not os.path.exists('checkpoints/' + args.exp_name):
+        os.makedirs('checkpoints/' + args.exp_name)
+    io = IOStream('checkpoints/' + args.exp_name + '/train.log')
+    io.cprint(str(args))
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    torch.manual_seed(args.seed)
+    if args.cuda:
+        torch.cuda.manual_seed(args.seed)
+
+    # shallow copies: own num_points, same shared arrays
+    train_set, test_set = copy.copy(_datasets['train']), copy.copy(_datasets['test'])
+    train_set.num_points = test_set.num_points = args.num_points
+    curve = []
+    stopped = []
+
+    def report(epoch, test_acc):
+        curve.append(test_acc)
+        _history[trial] = list(curve)
+        if _sweep.early_stop and median_stop(trial, epoch, max(curve), _sweep.grace, _sweep.min_trials):
+            stopped.append(epoch)
+            return False
+        return True
+
+    best = main_cls.train(args, io, train_set=train_set, test_set=test_set, report=report)
+    io.close()
+    return dict(trial=trial, best_acc=best, epochs=len(curve), stopped=bool(stopped),
+                minutes=(time.time() - start) / 60)
+
+
+def parse_grid(grid, parser):
+    # ['lr=0.1,0.01', 'use_sgd=True,False'] -> list of {name: value}, typed like main_cls.py
+    types = {action.dest: action.type for action in parser._actions}
+    axes = []
+    for item in grid:
+        name, values = item.split('=', 1)
+        if name not in types:
+            raise ValueError('unknown argument %s' % name)
+        if types[name] is bool:
+            cast = lambda v: v.lower() in ('true', '1', 'yes')
+        else:
+            cast = types[name] or str
+        axes.append([(name, cast(v)) for v in values.split(',')])
+    return [dict(combo) for combo in itertools.product(*axes)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep over main_cls.py',
+                                     epilog='the other arguments are passed to every trial as in main_cls.py')
+    parser.add_argument('--grid', type=str, nargs='+', required=True,
+                        help='name=v1,v2 per argument of main_cls.py, e.g. lr=0.1,0.01 k=16,20 use_sgd=True,False')
+    parser.add_argument('--sweep_name', type=str, default='sweep',
+                        help='trials are written to checkpoints/<sweep_name>/trialXXX')
+    parser.add_argument('--parallel', type=int, default=max(torch.cuda.device_count(), 1),
+                        help='trials running at the same time (default: one per GPU)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch threads per trial (default: cores / parallel)')
+    parser.add_argument('--early_stop', type=bool, default=False,
+                        help='stop trials below the median of the others at the same epoch')
+    parser.add_argument('--grace', type=int, default=10,
+                        help='epochs before a trial can be stopped')
+    parser.add_argument('--min_trials', type=int, default=3,
+                        help='other trials that must have reached the epoch to compare against')
+    sweep, rest = parser.parse_known_args()
+
+    trial_parser = main_cls.build_parser()
+    base = trial_parser.parse_args(rest)
+    base.eval = False
+    base.num_workers = 0  # pool processes are daemons, the loading runs in the prefetch thread
+    trials = parse_grid(sweep.grid, trial_parser)
+    if not os.path.exists('checkpoints/' + sweep.sweep_name):
+        os.makedirs('checkpoints/' + sweep.sweep_name)
+    threads = sweep.threads or max((os.cpu_count() or 1) // sweep.parallel, 1)
+    print('%d trials, %d at a time with %d threads each' % (len(trials), sweep.parallel, threads))
+
+    # loaded once with all 2048 points, every trial takes its num_points
+    datasets = {}
+    for partition in ('train', 'test'):
+        dataset = ModelNet40(partition=partition, num_points=2048, quantize=base.quantize)
+        datasets[partition] = detach_arrays(dataset)
+
+    ctx = mp.get_context('spawn')
+    manager = ctx.Manager()
+    history = manager.dict()
+    slots = manager.Queue()
+    for i in range(sweep.parallel):
+        slots.put(i)
+    jobs = []
+    pool = ctx.Pool(sweep.parallel, initializer=init_worker,
+                    initargs=(datasets, history, slots, threads, torch.cuda.device_count(), sweep))
+    for i, params in enumerate(trials):
+        args = copy.deepcopy(base)
+        for name, value in params.items():
+            setattr(args, name, value)
+        jobs.append(pool.apply_async(run_trial, (i, args)))
+    results = []
+    for params, job in zip(trials, jobs):
+        result = job.get()
+        result.update(params)
+        results.append(result)
+    pool.close()
+    pool.join()
+
+    names = sorted(trials[0])
+    columns = ['trial'] + names + ['best_acc', 'epochs', 'stopped', 'minutes']
+    results.sort(key=lambda r: -r['best_acc'])
+    print(' '.join('%12s' % c for c in columns))
+    for r in results:
+        print(' '.join('%12.6f' % r[c] if isinstance(r[c], float) else '%12s' % r[c] for c in columns))
+    with open('checkpoints/%s/summary.csv' % sweep.sweep_name, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for r in results:
+            writer.writerow({c: r[c] for c in columns})
+    print('==> checkpoints/%s/summary.csv' % sweep.sweep_name)
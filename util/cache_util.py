@@ -0,0 +1,250 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+from util.data_util import pc_normalize
+
+
+def canonicalize(points, num_points=1024, normalize=True, decimals=3):
+    '''
+        canonical form of a cloud, independent of its point order: normalized to
+        the unit sphere, sorted by the coordinates rounded to decimals and resampled
+        to num_points with a fixed seed. Clouds closer than the grid usually get the
+        same key, points lying on a cell boundary can still split them.
+        input: points, [N,C] array, xyz first
+        output: cloud, [num_points,C] float32, what the model is run on
+                grid, [num_points,C] int32, the rounded coordinates that are hashed
+    '''
+    points = np.asarray(points, dtype='float64')  # float32 rounding would move points across the grid
+    if normalize:
+        points = np.concatenate((pc_normalize(points[:, :3]), points[:, 3:]), axis=1)
+    grid = np.rint(points * 10 ** decimals).astype('int32')
+    order = np.lexsort(grid.T[::-1])
+    rng = np.random.RandomState(0)
+    if len(order) >= num_points:
+        choice = np.sort(rng.choice(len(order), num_points, replace=False))
+    else:
+        choice = np.sort(rng.choice(len(order), num_points, replace=True))
+    order = order[choice]
+    return points[order].astype('float32'), grid[order]
+
+
+def cloud_key(grid, version=''):
+    h = hashlib.sha1(str(version).encode())
+    h.update(np.ascontiguousarray(grid).tobytes())
+    h.update(str(grid.shape).encode())
+    return h.hexdigest()
+
+
+def file_version(path, block=1 << 20):
+    # digest of a checkpoint file, changes whenever the weights do
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PredictionCache():
+    '''
+        LRU cache of predictions bounded by max_entries and, if set, by ttl seconds
+        since insertion. With path the entries are loaded from and saved to disk
+        (save() writes them atomically), timestamps are wall-clock so the ttl also
+        holds across restarts. Thread-safe.
+    '''
+    def __init__(self, max_entries=100000, ttl=None, path=None, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (value, inserted)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dedup = 0  # duplicates inside one request, served without a lookup
+        self.evictions = 0
+        self.expirations = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _expired(self, inserted, now):
+        return self.ttl is not None and now - inserted > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry[1], self.clock()):
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def count_dedup(self, n=1):
+        with self.lock:
+            self.dedup += n
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, self.clock())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def purge(self):
+        # drops the expired entries, they are otherwise only dropped when looked up
+        with self.lock:
+            now = self.clock()
+            expired = [key for key, (_, inserted) in self.entries.items() if self._expired(inserted, now)]
+            for key in expired:
+                del self.entries[key]
+            self.expirations += len(expired)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(entries=len(self.entries), hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / float(lookups) if lookups else 0.0, dedup=self.dedup,
+                    evictions=self.evictions, expirations=self.expirations)
+
+    def save(self, path=None):
+        path = path or self.path
+        self.purge()
+        with self.lock:
+            entries = list(self.entries.items())
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path=None):
+        with open(path or self.path, 'rb') as f:
+            entries = pickle.load(f)
+        now = self.clock()
+        with self.lock:
+            for key, (value, inserted) in entries:
+                if not self._expired(inserted, now):
+                    self.entries[key] = (value, inserted)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class CachedPredictor():
+    '''
+        runs the model only on the clouds whose canonical form is not in the cache,
+        duplicates inside one request are also computed once. version identifies
+        the weights (e.g. file_version of the checkpoint) and is part of every key.
+    '''
+    def __init__(self, model, version, cache=None, num_points=1024, batch_size=32, device=None,
+                 normalize=True, decimals=3):
+        self.model = model
+        self.version = version
+        self.cache = cache if cache is not None else PredictionCache()
+        self.num_points = num_points
+        self.batch_size = batch_size
+        self.device = device if device is not None else next(model.parameters()).device
+        self.normalize = normalize
+        self.decimals = decimals
+
+    def predict(self, clouds):
+        '''
+            input: clouds, list of [N_i,3] arrays
+            output: logits, [M,num_classes] numpy array
+        '''
+        results = [None] * len(clouds)
+        pending = OrderedDict()  # key -> (canonical cloud, positions in the request)
+        for i, points in enumerate(clouds):
+            cloud, grid = canonicalize(points, self.num_points, self.normalize, self.decimals)
+            key = cloud_key(grid, self.version)
+            if key in pending:
+                pending[key][1].append(i)
+                self.cache.count_dedup()
+                continue
+            value = self.cache.get(key)
+            if value is not None:
+                results[i] = value
+            else:
+                pending[key] = (cloud, [i])
+
+        keys = list(pending)
+        with torch.no_grad():
+            for start in range(0, len(keys), self.batch_size):
+                batch = keys[start:start + self.batch_size]
+                data = torch.from_numpy(np.stack([pending[key][0] for key in batch]))
+                logits = self.model(data.to(self.device).permute(0, 2, 1)).cpu().numpy()
+                for key, value in zip(batch, logits):
+                    self.cache.put(key, value)
+                    for i in pending[key][1]:
+                        results[i] = value
+        return np.stack(results)
+
+
+if __name__ == '__main__':
+    import argparse
+    import torch.nn as nn
+    from util.data_util import load_data
+    from model.CWNet_cls import build_cwnet, CWNET_PRESETS
+    parser = argparse.ArgumentParser(description='Replay ModelNet40 test requests through the prediction cache')
+    parser.add_argument('--model', type=str, default='cwnet', choices=sorted(CWNET_PRESETS),
+                        help='model variant')
+    parser.add_argument('--model_path', type=str, default='checkpoints/cls/best_model.t7',
+                        help='Pretrained model path')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='clouds to replay')
+    parser.add_argument('--repeat', type=float, default=0.5,
+                        help='probability that a request resends an earlier cloud, shuffled, scaled and shifted')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='clouds per request')
+    parser.add_argument('--max_entries', type=int, default=100000)
+    parser.add_argument('--ttl', type=float, default=None,
+                        help='seconds an entry stays valid')
+    parser.add_argument('--cache_path', type=str, default=None,
+                        help='persist the cache to this file')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = nn.DataParallel(build_cwnet(args.model).to(device))
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    model = model.eval()
+    predictor = CachedPredictor(model, file_version(args.model_path),
+                                PredictionCache(args.max_entries, args.ttl, args.cache_path),
+                                num_points=args.num_points, batch_size=args.batch_size, device=device)
+
+    data, label = load_data('test')
+    rng = np.random.RandomState(0)
+    sent = []
+    requests = []
+    for _ in range(args.requests):
+        if sent and rng.rand() < args.repeat:
+            # a re-scan: same shape, other point order, units and origin
+            points = data[sent[rng.randint(len(sent))]]
+            points = points[rng.permutation(len(points))] * rng.uniform(0.5, 2) + rng.uniform(-1, 1, 3)
+        else:
+            sent.append(rng.randint(len(data)))
+            points = data[sent[-1]]
+        requests.append(points)
+
+    def replay(p):
+        start = time.time()
+        for i in range(0, len(requests), args.batch_size):
+            p.predict(requests[i:i + args.batch_size])
+        return time.time() - start
+
+    uncached = replay(CachedPredictor(model, 'uncached', PredictionCache(0), args.num_points, args.batch_size, device))
+    cached = replay(predictor)
+    print('uncached %.1f clouds/s, cached %.1f clouds/s' % (len(requests) / uncached, len(requests) / cached))
+    print(predictor.cache.stats())
+    if args.cache_path:
+        predictor.cache.save()
@@ -1,16 +1,20 @@
 import glob
 import h5py
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, Subset, IterableDataset
+from torch.utils.data.dataloader import default_collate
 import os
 import json
+import time
+import queue
+import threading
 import torch
 
 
 def load_data(partition):
     all_data = []
     all_label = []
-    for h5_name in glob.glob('./data/modelnet40_ply_hdf5_2048/ply_data_%s*.h5' % partition):
+    for h5_name in sorted(glob.glob('./data/modelnet40_ply_hdf5_2048/ply_data_%s*.h5' % partition)):
         f = h5py.File(h5_name)
         data = f['data'][:].astype('float32')
         label = f['label'][:].astype('int64')
@@ -22,6 +26,47 @@ def load_data(partition):
     return all_data, all_label
 
 
+def sidecar_path(partition, num_points):
+    return './data/modelnet40_ply_hdf5_2048/sidecar_%s_%d.h5' % (partition, num_points)
+
+
+def load_sidecar(partition, num_points):
+    # geometric descriptors and xyz knn indices written by precompute_descriptors.py
+    f = h5py.File(sidecar_path(partition, num_points), 'r')
+    descriptor = f['descriptor'][:].astype('float32')  # M,8,N
+    knn_idx = f['knn_idx'][:].astype('int64')  # M,N,k
+    f.close()
+    return descriptor, knn_idx
+
+
+def quantize_pointclouds(data):
+    '''
+        per-cloud bounding box quantization to int16
+        input: data, [M,N,C] float
+        output: q, [M,N,C] int16
+                offset, scale, [M,1,C] float32, data ~= (q + 32768) * scale + offset
+    '''
+    offset = data.min(axis=1, keepdims=True).astype('float32')
+    scale = ((data.max(axis=1, keepdims=True) - offset) / 65535.).astype('float32')
+    scale = np.maximum(scale, np.float32(1e-12))
+    q = np.rint((data - offset) / scale) - 32768
+    return q.astype('int16'), offset, scale
+
+
+def dequantize_pointclouds(q, offset, scale):
+    # numpy arrays or torch tensors of any leading shape
+    if torch.is_tensor(q):
+        return (q.float() + 32768) * scale + offset
+    return ((q.astype('float32') + 32768) * scale + offset).astype('float32')
+
+
+def dequantize_collate(batch):
+    # (q, offset, scale, label, ...) samples -> (pointcloud, label, ...) batch, dequantized at once
+    q, offset, scale, label = [default_collate(b) for b in list(zip(*batch))[:4]]
+    rest = [default_collate(b) for b in list(zip(*batch))[4:]]
+    return [dequantize_pointclouds(q, offset, scale), label.long()] + rest
+
+
 def pc_normalize(pc):
     centroid = np.mean(pc, axis=0)
     pc = pc - centroid
@@ -52,25 +97,171 @@ def add_noise(pointcloud,mean=0,stddev=0.02):
 
 # =========== ModelNet40 =================
 class ModelNet40(Dataset):
-    def __init__(self, num_points, partition='train'):
+    def __init__(self, num_points, partition='train', sidecar=False, augment=None, quantize=False):
         self.data, self.label = load_data(partition)
+        # int16 points and uint8 labels in memory, batches come from dequantize_collate
+        self.quantize = quantize
+        if quantize:
+            self.data, self.offset, self.scale = quantize_pointclouds(self.data)
+            self.label = self.label.astype('uint8')
         self.num_points = num_points
         self.partition = partition  # Here the new given partition will cover the 'train'
+        self.augment = partition == 'train' if augment is None else augment
+        self.sidecar = sidecar  # also return the precomputed descriptor and xyz knn indices
+        if sidecar:
+            if self.augment:
+                raise ValueError('precomputed descriptors are only valid for un-augmented data')
+            self.descriptor, self.knn_idx = load_sidecar(partition, num_points)
+            assert self.descriptor.shape[0] == self.data.shape[0], 'sidecar does not match the dataset'
 
     def __getitem__(self, item):  # indice of the pts or label
         pointcloud = self.data[item][:self.num_points]
         label = self.label[item]
-        if self.partition == 'train':
+        if self.quantize:
+            return self._quantized_item(item, pointcloud, label)
+        if self.augment:
             # pointcloud = pc_normalize(pointcloud)  # you can try to add it or not to train our model
             pointcloud = translate_pointcloud(pointcloud)
             # pointcloud=add_noise(pointcloud)
             np.random.shuffle(pointcloud)  # shuffle the order of pts
+        if self.sidecar:
+            return pointcloud, label, self.descriptor[item], self.knn_idx[item]
         return pointcloud, label
 
+    def _quantized_item(self, item, q, label):
+        offset, scale = self.offset[item], self.scale[item]
+        if self.augment:
+            # translate_pointcloud folded into the dequantization: (x*xyz1 + xyz2)
+            xyz1 = np.random.uniform(low=2./3., high=3./2., size=[3]).astype('float32')
+            xyz2 = np.random.uniform(low=-0.2, high=0.2, size=[3]).astype('float32')
+            offset, scale = offset * xyz1 + xyz2, scale * xyz1
+            q = q[np.random.permutation(len(q))]  # shuffle the order of pts
+        if self.sidecar:
+            return q, offset, scale, label, self.descriptor[item], self.knn_idx[item]
+        return q, offset, scale, label
+
     def __len__(self):
         return self.data.shape[0]
 
 
+def train_val_split(num_samples, val_split, seed=0):
+    # fixed held-out part of the train partition, e.g. to calibrate the early exits
+    perm = np.random.RandomState(seed).permutation(num_samples)
+    num_val = int(round(num_samples * val_split))
+    return np.sort(perm[num_val:]), np.sort(perm[:num_val])
+
+
+# =========== Data loading =================
+def auto_num_workers(num_workers=-1):
+    # negative: one worker per free core, shared between the visible GPUs
+    if num_workers >= 0:
+        return num_workers
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    gpus = max(torch.cuda.device_count(), 1)
+    return max(min(cpus - 1, 4 * gpus, 16), 0)
+
+
+DATASET_ARRAYS = ('data', 'label', 'offset', 'scale', 'descriptor', 'knn_idx')
+
+
+def share_dataset(dataset):
+    # move the dataset arrays to shared memory, the workers map them instead of copying
+    if isinstance(dataset, Subset):
+        share_dataset(dataset.dataset)
+        return dataset
+    if getattr(dataset, 'shared_memory', False):
+        return dataset
+    for name in DATASET_ARRAYS:
+        array = getattr(dataset, name, None)
+        if isinstance(array, np.ndarray):
+            setattr(dataset, name, torch.from_numpy(np.ascontiguousarray(array)).share_memory_().numpy())
+    dataset.shared_memory = True
+    return dataset
+
+
+def seed_worker(worker_id):
+    # persistent workers are forked once, give each its own numpy stream for the augmentation
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+class PrefetchLoader():
+    '''
+        Runs the DataLoader iteration (and the host to device copy) in a background
+        thread, batches are queued ahead of the training step.
+        stall_time: seconds the consumer waited for a batch during the last epoch
+    '''
+    def __init__(self, loader, queue_size=2, device=None):
+        self.loader = loader
+        self.queue_size = queue_size
+        self.device = device
+        self.stall_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        if self.device is None:
+            return batch
+        return [b.to(self.device, non_blocking=True) if torch.is_tensor(b) else b for b in batch]
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, q, stop):
+        try:
+            for batch in self.loader:
+                if not self._put(q, self._to_device(batch), stop):
+                    return
+        except Exception as e:
+            self._put(q, e, stop)
+            return
+        self._put(q, None, stop)
+
+    def __iter__(self):
+        self.stall_time = 0.0
+        q = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                item = q.get()
+                self.stall_time += time.time() - start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+def build_loader(dataset, batch_size, shuffle, drop_last, num_workers=-1, prefetch=2, device=None,
+                 collate_fn=None):
+    num_workers = auto_num_workers(num_workers)
+    share_dataset(dataset)
+    if isinstance(dataset, IterableDataset):
+        shuffle = False  # streaming datasets shuffle themselves
+    pin_memory = device is not None and torch.device(device).type == 'cuda'
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = dict(persistent_workers=True, prefetch_factor=prefetch, worker_init_fn=seed_worker)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                        num_workers=num_workers, pin_memory=pin_memory, collate_fn=collate_fn, **kwargs)
+    return PrefetchLoader(loader, queue_size=prefetch, device=device)
+
+
 # =========== ShapeNet Part =================
 class PartNormalDataset(Dataset):
     def __init__(self, npoints=2500, split='train', normalize=False):
@@ -0,0 +1,105 @@
+import copy
+import torch
+
+
+def estimate_memory(model, batch_size, num_points, training=True, bytes_per_element=4):
+    '''
+        Analytic peak memory of CWNET in bytes, counted from the B,C,N,k activations
+        of deepconv/Point_Transformer and the B,N,N matrices of knn/Trans2.
+        training: activations kept for backward + weights, grads and SGD momentum
+        inference: the largest set of tensors alive at the same time, plus the stage outputs
+    '''
+    B, N = batch_size, num_points
+    widths, ks = model.widths, model.k
+    emb_dims = model.out[0].out_channels
+    params = sum(p.numel() for p in model.parameters())
+
+    saved = 0  # kept for backward, per cloud
+    transient = []  # alive at the same time inside a stage in training, per cloud
+    live = []  # alive at the same time inside a stage in inference, per cloud
+    # stage 1: descriptor knn, graph feature of the 8-d descriptor, dc1 and pointrans1
+    w, k = widths[0], ks[0]
+    graph = 16 * N * k
+    dc = 3 * 16 * N * k + 3 * w * N * k
+    pointrans = 15 * w * N * k + 3 * N * k
+    saved += graph + dc + pointrans
+    transient.append(3 * N * N + 2 * graph + dc + pointrans)
+    live.append(max(3 * N * N, 2 * graph, 2 * graph + w * N * k, 5 * w * N * k + 3 * N * k))
+    # stages 2..: feature knn, graph feature, deepconv, Trans2, DFA
+    for i in range(1, len(widths)):
+        c, w, k = widths[i - 1], widths[i], ks[i]
+        graph = 2 * c * N * k
+        dc = 3 * 2 * c * N * k + 3 * w * N * k
+        trans = 2 * N * N + 8 * w * N
+        saved += graph + dc + trans + 6 * w * N
+        transient.append(max(3 * N * N, trans) + 2 * graph + dc)
+        live.append(max(3 * N * N, 2 * graph, 2 * graph + w * N * k, 2 * N * N + 4 * w * N))
+    # head: out conv and pooling
+    saved += 3 * emb_dims * N + 2 * sum(widths) * N
+    transient.append(sum(widths) * N + 3 * emb_dims * N)
+    live.append(sum(widths) * N + 2 * emb_dims * N)
+
+    if training:
+        weights = 3 * params  # weights, grads, momentum
+        activations = B * (saved + max(transient))
+    else:
+        weights = params
+        activations = B * (max(live) + sum(widths) * N)
+    return dict(weights=weights * bytes_per_element,
+                activations=activations * bytes_per_element,
+                peak=(weights + activations) * bytes_per_element)
+
+
+def measure_memory(model, batch_size, num_points, training=True):
+    # empirical peak CUDA memory in bytes of one step, None when it runs out of memory
+    device = next(model.parameters()).device
+    state = copy.deepcopy(model.state_dict())  # the BN statistics change in training mode
+    model.train(training)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        data = torch.rand(batch_size, 3, num_points, device=device)
+        if training:
+            model(data).sum().backward()
+            model.zero_grad()
+        else:
+            with torch.no_grad():
+                model(data)
+        peak = torch.cuda.max_memory_allocated(device)
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        peak = None
+    model.zero_grad()
+    model.load_state_dict(state)
+    torch.cuda.empty_cache()
+    return peak
+
+
+def tune_batch_size(model, num_points, budget, training=True, empirical=None, max_batch_size=1024):
+    '''
+        largest batch size whose peak memory fits in budget bytes. The analytic
+        model gives the estimate; on CUDA the peak is also measured at two batch
+        sizes, extrapolated linearly and the result backed off until it fits.
+    '''
+    if empirical is None:
+        empirical = next(model.parameters()).is_cuda
+    fixed = estimate_memory(model, 0, num_points, training)['peak']
+    per_cloud = estimate_memory(model, 1, num_points, training)['peak'] - fixed
+    batch_size = int((budget - fixed) // per_cloud)
+    if not empirical:
+        return max(min(batch_size, max_batch_size), 1)
+
+    small = max(min(batch_size // 4, 8), 2)  # BatchNorm needs two clouds in training
+    m1 = measure_memory(model, small, num_points, training)
+    m2 = measure_memory(model, 2 * small, num_points, training)
+    if m1 is None or m2 is None:
+        return small if m1 is not None else 1
+    per_cloud = max((m2 - m1) / float(small), 1)
+    batch_size = max(min(int((budget - (m1 - small * per_cloud)) // per_cloud), max_batch_size), 1)
+    while batch_size > 1:
+        peak = measure_memory(model, batch_size, num_points, training)
+        if peak is not None and peak <= budget:
+            break
+        batch_size = int(batch_size * 0.9)
+    return batch_size
@@ -0,0 +1,88 @@
+import time
+import numpy as np
+import torch
+
+
+class ShapeIndex():
+    '''
+        Exact nearest-shape search over a feature matrix written by extract_features.py.
+        The catalog stays memory-mapped and is scanned in chunks, every chunk is
+        scored against a whole batch of queries at once and merged into a running top-k.
+        metric: 'cosine' or 'l2'
+        in_memory: keep the whole catalog on the device instead of streaming it
+    '''
+    def __init__(self, path, metric='cosine', device='cpu', chunk=65536, in_memory=False):
+        self.features = np.load(path if path.endswith('.npy') else path + '.npy', mmap_mode='r')
+        self.metric = metric
+        self.device = torch.device(device)
+        self.chunk = chunk
+        self.cache = None
+        if in_memory:
+            self.cache = [self._prepare(i) for i in range(0, len(self), chunk)]
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def _prepare(self, start):
+        feat = torch.from_numpy(np.array(self.features[start:start + self.chunk]))
+        feat = feat.to(self.device).float()
+        if self.metric == 'cosine':
+            return feat / feat.norm(dim=1, keepdim=True).clamp(min=1e-12), None
+        return feat, torch.sum(feat ** 2, dim=1)
+
+    def search(self, queries, k=10):
+        '''
+            input: queries, [Q,D] numpy array or tensor
+            output: scores, [Q,k] cosine similarity or negative squared distance
+                    idx, [Q,k] rows of the catalog
+        '''
+        queries = torch.as_tensor(np.asarray(queries) if not torch.is_tensor(queries) else queries)
+        queries = queries.to(self.device).float()
+        if self.metric == 'cosine':
+            queries = queries / queries.norm(dim=1, keepdim=True).clamp(min=1e-12)
+        k = min(k, len(self))
+        best_score = torch.full((queries.size(0), 0), -float('inf'), device=self.device)
+        best_idx = torch.zeros((queries.size(0), 0), dtype=torch.long, device=self.device)
+        for n, start in enumerate(range(0, len(self), self.chunk)):
+            feat, sq = self.cache[n] if self.cache is not None else self._prepare(start)
+            score = torch.matmul(queries, feat.t())  # Q,chunk
+            if self.metric == 'l2':
+                score = 2 * score - sq.view(1, -1) - torch.sum(queries ** 2, dim=1, keepdim=True)
+            score, idx = score.topk(k=min(k, score.size(1)), dim=1)
+            best_score = torch.cat((best_score, score), dim=1)
+            best_idx = torch.cat((best_idx, idx + start), dim=1)
+            best_score, top = best_score.topk(k=min(k, best_score.size(1)), dim=1)
+            best_idx = torch.gather(best_idx, 1, top)
+        return best_score.cpu().numpy(), best_idx.cpu().numpy()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Batched nearest-shape retrieval')
+    parser.add_argument('--catalog', type=str, required=True,
+                        help='feature prefix of the catalog (extract_features.py --out)')
+    parser.add_argument('--queries', type=str, required=True,
+                        help='feature prefix of the queries')
+    parser.add_argument('--k', type=int, default=10,
+                        help='neighbors per query')
+    parser.add_argument('--metric', type=str, default='cosine', choices=['cosine', 'l2'])
+    parser.add_argument('--batch_size', type=int, default=1024,
+                        help='queries per batch')
+    parser.add_argument('--in_memory', type=bool, default=False,
+                        help='keep the catalog on the device')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    index = ShapeIndex(args.catalog, metric=args.metric, device=device, in_memory=args.in_memory)
+    queries = np.load(args.queries + '.npy', mmap_mode='r')
+    catalog_label = np.load(args.catalog + '_label.npy')
+    query_label = np.load(args.queries + '_label.npy')
+
+    hits = 0.0
+    start = time.time()
+    for i in range(0, len(queries), args.batch_size):
+        _, idx = index.search(queries[i:i + args.batch_size], k=args.k)
+        hits += np.sum(catalog_label[idx] == query_label[i:i + args.batch_size, None])
+    elapsed = time.time() - start
+    print('%d queries over %d shapes: precision@%d %.4f, %.1f queries/s'
+          % (len(queries), len(index), args.k, hits / (len(queries) * args.k), len(queries) / elapsed))
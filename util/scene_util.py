@@ -0,0 +1,129 @@
+import os
+import glob
+import json
+import math
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from model.CWNet_cls import index_points, knn_point
+from model.cuda_ops import furthest_point_sample
+
+
+# =========== Tiled scenes =================
+# <root>/index.json: scene size, xy origin, tile size, halo and the tiles
+# with core points. Every tile is four flat files appended chunk by chunk:
+#   <name>_core.xyz, <name>_halo.xyz  float32 [n,3]
+#   <name>_core.idx, <name>_halo.idx  int64 [n], rows of the points in the scene
+# core points fall inside the tile, halo points within halo of its border.
+
+
+def scene_bounds(points, chunk=1 << 20):
+    lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+    for i in range(0, len(points), chunk):
+        xyz = np.asarray(points[i:i + chunk, :3], dtype='float64')
+        lo, hi = np.minimum(lo, xyz.min(axis=0)), np.maximum(hi, xyz.max(axis=0))
+    return lo, hi
+
+
+def _append(root, name, xyz, rows):
+    with open(os.path.join(root, name + '.xyz'), 'ab') as f:
+        f.write(np.ascontiguousarray(xyz, dtype='float32').tobytes())
+    with open(os.path.join(root, name + '.idx'), 'ab') as f:
+        f.write(np.ascontiguousarray(rows, dtype='int64').tobytes())
+
+
+def tile_scene(path, root, tile_size=10.0, halo=1.0, chunk=1 << 20):
+    '''
+        bins a [P,C] .npy scene (xyz first) into square xy tiles with a halo,
+        the scene is memory-mapped and read chunk points at a time.
+    '''
+    assert halo < tile_size, 'the halo of a tile must end inside its neighbors'
+    points = np.load(path, mmap_mode='r')
+    if not os.path.exists(root):
+        os.makedirs(root)
+    for name in glob.glob(os.path.join(root, 'tile*_*.*')):
+        os.remove(name)  # the tile files are appended to
+    lo, hi = scene_bounds(points, chunk)
+    origin = lo[:2]
+    grid = np.maximum(np.ceil((hi[:2] - origin) / tile_size), 1).astype('int64')
+    counts = {}
+    for start in range(0, len(points), chunk):
+        xyz = np.asarray(points[start:start + chunk, :3], dtype='float32')
+        rows = np.arange(start, start + len(xyz))
+        cell = np.clip(np.floor((xyz[:, :2] - origin) / tile_size).astype('int64'), 0, grid - 1)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                tile = cell + np.array([dx, dy])
+                valid = np.all((tile >= 0) & (tile < grid), axis=1)
+                if dx or dy:
+                    tile_lo = origin + tile * tile_size - halo
+                    valid &= np.all((xyz[:, :2] >= tile_lo) & (xyz[:, :2] < tile_lo + tile_size + 2 * halo), axis=1)
+                kind = 'halo' if dx or dy else 'core'
+                tid = tile[valid, 0] * grid[1] + tile[valid, 1]
+                order = np.argsort(tid, kind='stable')
+                tid, sel = tid[order], np.nonzero(valid)[0][order]
+                ids, first = np.unique(tid, return_index=True)
+                for t, a, b in zip(ids, first, list(first[1:]) + [len(tid)]):
+                    _append(root, 'tile%06d_%s' % (t, kind), xyz[sel[a:b]], rows[sel[a:b]])
+                    counts.setdefault(int(t), dict(core=0, halo=0))[kind] += int(b - a)
+    tiles = [dict(name='tile%06d' % t, core=c['core'], halo=c['halo'])
+             for t, c in sorted(counts.items()) if c['core'] > 0]
+    index = dict(num_points=len(points), origin=origin.tolist(), tile_size=tile_size, halo=halo,
+                 grid=grid.tolist(), tiles=tiles)
+    with open(os.path.join(root, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+class SceneWindows(Dataset):
+    '''
+        One item per tile: windows of the num_points nearest neighbors (halo
+        included) around seeds spread over the core points by farthest point
+        sampling, about coverage windows per core point. Windows are centered
+        and scaled to the unit sphere like the ModelNet40 clouds.
+        item: windows, [S,num_points,3]
+              neighbors, [S,num_points] tile points of every window
+              points, [n,3] tile points, the core points first
+              rows, [n] scene rows of the tile points
+              seeds, [S] tile points the windows are centered on
+              num_core
+    '''
+    def __init__(self, root, num_points=1024, coverage=2.0, seed_batch=64):
+        self.root = root
+        with open(os.path.join(root, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        self.tiles = self.index['tiles']
+        self.num_points = num_points
+        self.coverage = coverage
+        self.seed_batch = seed_batch  # seeds per knn, bounds the S x n distance matrix
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def load(self, tile):
+        xyz, rows = [], []
+        for kind in ('core', 'halo'):
+            name = os.path.join(self.root, '%s_%s' % (tile['name'], kind))
+            if tile[kind] > 0:
+                xyz.append(np.fromfile(name + '.xyz', dtype='float32').reshape(-1, 3))
+                rows.append(np.fromfile(name + '.idx', dtype='int64'))
+        return np.concatenate(xyz), np.concatenate(rows)
+
+    def __getitem__(self, item):
+        tile = self.tiles[item]
+        xyz, rows = self.load(tile)
+        num_core = tile['core']
+        points = torch.from_numpy(xyz)
+        num_windows = min(max(int(math.ceil(self.coverage * num_core / self.num_points)), 1), num_core)
+        seeds = furthest_point_sample(points[None, :num_core], num_windows)[0]  # S
+        k = min(self.num_points, len(points))
+        neighbors = torch.cat([knn_point(k, points[None], points[None, seeds[i:i + self.seed_batch]])[0]
+                               for i in range(0, num_windows, self.seed_batch)], dim=0)  # S,k
+        if k < self.num_points:
+            # small tiles: repeat points like ModelNet40 clouds with few points
+            extra = torch.randint(k, (num_windows, self.num_points - k))
+            neighbors = torch.cat((neighbors, torch.gather(neighbors, 1, extra)), dim=1)
+        windows = index_points(points[None], neighbors[None])[0]  # S,num_points,3
+        windows = windows - windows.mean(dim=1, keepdim=True)
+        windows = windows / windows.norm(dim=2).max(dim=1)[0].clamp(min=1e-12).view(-1, 1, 1)
+        return windows, neighbors, points, torch.from_numpy(rows), seeds, num_core
@@ -0,0 +1,211 @@
+import os
+import glob
+import json
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from util.data_util import translate_pointcloud, dequantize_pointclouds, PartNormalDataset
+
+
+# =========== Sharded format =================
+# <root>/index.json lists the shards and their sample counts, every shard is an
+# uncompressed .npz read sequentially in one go:
+#   points  [sum N_i, C] float32, the clouds one after another
+#   offsets [M+1] int64, cloud i is points[offsets[i]:offsets[i+1]]
+#   label   [M] int64
+#   seg     [sum N_i] int32, per-point part labels (ShapeNet Part only)
+# quantized shards store the points as int16 relative to the bounding box of
+# every cloud (qpoints, qmin [M,C], qscale [M,C]) and labels as uint8.
+
+
+class ShardWriter():
+    def __init__(self, root, shard_size=2048, quantize=False):
+        self.root = root
+        self.shard_size = shard_size  # clouds per shard
+        self.quantize = quantize
+        self.shards = []
+        self._reset()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _reset(self):
+        self.points = []
+        self.labels = []
+        self.segs = []
+
+    def add(self, points, label, seg=None):
+        self.points.append(np.asarray(points, dtype='float32'))
+        self.labels.append(int(label))
+        if seg is not None:
+            self.segs.append(np.asarray(seg, dtype='int32'))
+        if len(self.points) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.points:
+            return
+        name = 'shard-%05d.npz' % len(self.shards)
+        arrays = dict(points=np.concatenate(self.points, axis=0),
+                      offsets=np.cumsum([0] + [len(p) for p in self.points]).astype('int64'),
+                      label=np.array(self.labels, dtype='int64'))
+        if self.quantize:
+            arrays.update(self._quantize(arrays.pop('points'), arrays['offsets']))
+            if arrays['label'].max() < 256:
+                arrays['label'] = arrays['label'].astype('uint8')
+        if self.segs:
+            arrays['seg'] = np.concatenate(self.segs, axis=0)
+        np.savez(os.path.join(self.root, name), **arrays)
+        self.shards.append(dict(file=name, count=len(self.points)))
+        self._reset()
+
+    def _quantize(self, points, offsets):
+        cloud = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))  # cloud of every point
+        qmin = np.minimum.reduceat(points, offsets[:-1], axis=0)
+        qscale = np.maximum((np.maximum.reduceat(points, offsets[:-1], axis=0) - qmin) / 65535., 1e-12)
+        q = np.rint((points - qmin[cloud]) / qscale[cloud]) - 32768
+        return dict(qpoints=q.astype('int16'), qmin=qmin.astype('float32'), qscale=qscale.astype('float32'))
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.root, 'index.json'), 'w') as f:
+            json.dump(dict(shards=self.shards), f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_modelnet40_shards(partition, root, shard_size=2048, chunk=256, quantize=False):
+    # streams the HDF5 files chunk by chunk, memory stays bounded by one shard
+    with ShardWriter(root, shard_size, quantize) as writer:
+        for h5_name in sorted(glob.glob('./data/modelnet40_ply_hdf5_2048/ply_data_%s*.h5' % partition)):
+            f = h5py.File(h5_name, 'r')
+            for i in range(0, f['data'].shape[0], chunk):
+                data = f['data'][i:i + chunk].astype('float32')
+                label = f['label'][i:i + chunk].astype('int64').reshape(-1)
+                for points, l in zip(data, label):
+                    writer.add(points, l)
+            f.close()
+    return writer.shards
+
+
+def write_shapenetpart_shards(split, root, shard_size=2048, quantize=False):
+    # xyz + normals as 6 channels, the per-point part labels as seg
+    dataset = PartNormalDataset(split=split)
+    with ShardWriter(root, shard_size, quantize) as writer:
+        for cat, fn in dataset.datapath:
+            data = np.loadtxt(fn).astype(np.float32)
+            writer.add(data[:, 0:6], dataset.classes[cat], seg=data[:, -1])
+    return writer.shards
+
+
+class ShardedPointCloudDataset(IterableDataset):
+    '''
+        Streams the shards of a sharded dataset: shards are read whole and in
+        sequence, samples are shuffled inside a bounded buffer, the shards are
+        split between the distributed ranks and then between the loader workers.
+        Every pass over the data is a new epoch with a new shard order, this also
+        holds inside persistent workers.
+        epoch, start_shard: resume at that epoch, after the first start_shard shards
+    '''
+    def __init__(self, root, num_points=1024, shuffle_buffer=0, augment=False, seed=0,
+                 epoch=0, start_shard=0, rank=None, world_size=None):
+        self.root = root
+        with open(os.path.join(root, 'index.json'), 'r') as f:
+            self.shards = json.load(f)['shards']
+        self.num_points = num_points
+        self.shuffle_buffer = shuffle_buffer
+        self.augment = augment
+        self.seed = seed
+        self.start_shard = start_shard
+        self.epoch = epoch
+        if rank is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size or 1
+
+    def shard_order(self, epoch, start_shard=0):
+        order = np.arange(len(self.shards))
+        if self.shuffle_buffer > 0:
+            np.random.RandomState(self.seed + epoch).shuffle(order)
+        return order[start_shard:][self.rank::self.world_size]
+
+    def __len__(self):
+        # samples of this rank in the next epoch, the workers split them
+        return int(sum(self.shards[i]['count'] for i in self.shard_order(self.epoch, self.start_shard)))
+
+    def _samples(self, shard):
+        arrays = np.load(os.path.join(self.root, shard['file']))
+        offsets, label = arrays['offsets'], arrays['label'].astype('int64')
+        if 'qpoints' in arrays.files:
+            # dequantize the whole shard at once
+            cloud = np.repeat(np.arange(len(label)), np.diff(offsets))
+            points = dequantize_pointclouds(arrays['qpoints'], arrays['qmin'][cloud], arrays['qscale'][cloud])
+        else:
+            points = arrays['points']
+        seg = arrays['seg'] if 'seg' in arrays.files else None
+        for i in range(len(label)):
+            pointcloud = points[offsets[i]:offsets[i + 1]]
+            if len(pointcloud) >= self.num_points:
+                choice = np.arange(self.num_points)
+            else:
+                choice = np.random.choice(len(pointcloud), self.num_points, replace=True)
+            pointcloud = pointcloud[choice]
+            if self.augment:
+                pointcloud = pointcloud.copy()
+                pointcloud[:, :3] = translate_pointcloud(pointcloud[:, :3])
+                perm = np.random.permutation(self.num_points)  # shuffle the order of pts
+                pointcloud, choice = pointcloud[perm], choice[perm]
+            if seg is None:
+                yield pointcloud, label[i:i + 1]
+            else:
+                yield pointcloud, label[i:i + 1], seg[offsets[i]:offsets[i + 1]][choice]
+
+    def __iter__(self):
+        epoch, start_shard = self.epoch, self.start_shard
+        self.epoch, self.start_shard = epoch + 1, 0  # the resume offset only applies once
+        order = self.shard_order(epoch, start_shard)
+        worker = get_worker_info()
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+        rng = np.random.RandomState((self.seed + epoch) * 1000 + (worker.id if worker else 0))
+        buffer = []
+        for i in order:
+            for sample in self._samples(self.shards[i]):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                if not buffer:
+                    yield sample
+                    continue
+                j = rng.randint(len(buffer))
+                buffer[j], sample = sample, buffer[j]
+                yield sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert a dataset to the sharded format')
+    parser.add_argument('--dataset', type=str, default='modelnet40', choices=['modelnet40', 'shapenetpart'])
+    parser.add_argument('--partition', type=str, default='train',
+                        help='partition of ModelNet40 or split of ShapeNet Part')
+    parser.add_argument('--out', type=str, required=True,
+                        help='output directory')
+    parser.add_argument('--shard_size', type=int, default=2048,
+                        help='clouds per shard')
+    parser.add_argument('--quantize', type=bool, default=False,
+                        help='store int16 points and uint8 labels')
+    args = parser.parse_args()
+    if args.dataset == 'modelnet40':
+        shards = write_modelnet40_shards(args.partition, args.out, args.shard_size, quantize=args.quantize)
+    else:
+        shards = write_shapenetpart_shards(args.partition, args.out, args.shard_size, quantize=args.quantize)
+    print('%d clouds in %d shards -> %s' % (sum(s['count'] for s in shards), len(shards), args.out))